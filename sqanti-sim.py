@@ -16,11 +16,11 @@ import numpy
 import os
 import random
 import sys
-from collections import defaultdict
 from src import classify_gtf
 from src import simulate_reads
 from src import design_simulation
 from src import evaluation_metrics
+from src import transcript_cache
 from time import strftime
 
 
@@ -67,6 +67,127 @@ def classif(input: list):
     print("[SQANTI-SIM][%s] classif step finished" %(strftime("%d-%m-%Y %H:%M:%S")))
 
 
+def check_design_args(args: argparse.Namespace, name: str = None):
+    """Checks the parameters of one design
+
+    Exits if a probability or Negative Binomial parameter is out of range and
+    warns if -nt is lower than the novel transcripts to simulate
+
+    Args:
+        args (argparse.Namespace): parameters of the design
+        name (str): design name shown in the messages of batch mode
+    """
+
+    prefix = "design %s: " %(name) if name else ""
+
+    total_novel = sum([args.ISM, args.NIC, args.NNC, args.Fusion, args.Antisense, args.GG, args.GI, args.Intergenic])
+    if args.trans_number is not None and total_novel > args.trans_number:
+        print("[SQANTI-SIM] WARNING: %s-nt is lower than the novel transcripts to simulate, only novel transcripts will be simulated" %(prefix), file=sys.stderr)
+
+    if args.mode == "custom":
+        if args.nbn_known < 0 or args.nbn_novel < 0:
+            print("[SQANTI-SIM] ERROR: %s--nbn_known and --nbn_novel must be greater than 0" %(prefix), file=sys.stderr)
+            sys.exit(1)
+        if args.nbp_known < 0 or args.nbp_known > 1 or args.nbp_novel < 0 or args.nbp_novel > 1:
+            print("[SQANTI-SIM] ERROR: %s--nbp_known and --nbp_novel must be in the interval [0,1]" %(prefix), file=sys.stderr)
+            sys.exit(1)
+
+    elif args.mode == "sample":
+        if args.low_prob < 0 or args.low_prob > 1 or args.high_prob < 0 or args.high_prob > 1:
+            print("[SQANTI-SIM] ERROR: %s--low_prob and --high_prob must be in the interval [0,1]" %(prefix), file=sys.stderr)
+            sys.exit(1)
+
+
+def design_batch_args(parser: argparse.ArgumentParser, mode_parser: argparse.ArgumentParser, input: list,
+                      args: argparse.Namespace) -> list:
+    """Parameters of each design generated in batch mode
+
+    Each row of the --grid file overrides the command line parameters of one
+    design, and each design is repeated --replicates times with consecutive
+    seeds. The output prefix of each design is <output>_<name>_rep<N>
+
+    Args:
+        parser (argparse.ArgumentParser): design mode parser
+        mode_parser (argparse.ArgumentParser): parser of the selected mode (equal, custom or sample)
+        input (list): arguments to parse
+        args (argparse.Namespace): command line parameters
+
+    Returns:
+        designs (list): parameters of each design
+    """
+
+    # These parameters must be shared by all the designs
+    fixed = ["mode", "trans_index", "gtf", "genome", "pb_reads", "ont_reads",
+             "mapped_reads", "expr_profile", "cache_dir", "stream_align", "dir", "output",
+             "cores", "replicates", "grid"]
+
+    # Grid columns can be the parameter names (dest) or any of their flags (i.e. nt, -nt, --trans_number)
+    columns = dict()
+    for flag, action in mode_parser._option_string_actions.items():
+        if action.dest in fixed or action.dest == "help":
+            continue
+        columns[flag] = action
+        columns[flag.lstrip("-")] = action
+        columns[action.dest] = action
+
+    rows = []
+    if args.grid:
+        with open(args.grid, "r") as f_in:
+            header = f_in.readline().rstrip("\n").split("\t")
+            for col in header:
+                if col != "name" and col not in columns:
+                    valid = sorted(set([action.dest for action in columns.values()]))
+                    print("[SQANTI-SIM] ERROR: %s can not be used as a --grid column. Valid columns are: name, %s" %(
+                        col, ", ".join(valid)), file=sys.stderr)
+                    sys.exit(1)
+            for line in f_in:
+                if not line.strip():
+                    continue
+                rows.append(dict(zip(header, line.rstrip("\n").split("\t"))))
+        f_in.close()
+    else:
+        rows.append(dict())
+
+    designs = []
+    for i, row in enumerate(rows):
+        # Parse again with the grid values so they are checked and cast as the command line ones
+        extra = []
+        flags = dict()
+        seed = None
+        for col, value in row.items():
+            if col == "name":
+                continue
+            action = columns[col]
+            if action.dest == "seed":
+                seed = int(value)
+            elif isinstance(getattr(args, action.dest), bool):
+                flags[action.dest] = value.lower() in ["true", "1", "yes"]
+            else:
+                extra.extend([action.option_strings[-1], value])
+        row_args, unknown = parser.parse_known_args(input + extra)
+        for col, value in flags.items():
+            setattr(row_args, col, value)
+
+        if seed is None:
+            seed = args.seed + i * args.replicates
+
+        if args.grid:
+            name = args.output + "_" + row.get("name", "design" + str(i + 1))
+            check_design_args(row_args, name)
+        else:
+            name = args.output
+
+        for r in range(args.replicates):
+            d = argparse.Namespace(**vars(row_args))
+            d.output = name
+            if args.replicates > 1:
+                d.output += "_rep" + str(r + 1)
+            d.seed = seed + r
+            designs.append(d)
+
+    return designs
+
+
 def design(input: list):
     """Modifies reference annotation GTF and builds expression matrix
 
@@ -97,6 +218,8 @@ def design(input: list):
     parser_e.add_argument("--Intergenic", type=int, default=0, help="\t\tNumber of Intergenic to simulate", )
     parser_e.add_argument("-k", "--cores", type=int, default=1, help="\t\tNumber of cores to run in parallel", )
     parser_e.add_argument("-s", "--seed", type=int, default=None, help="\t\tRandomizer seed", )
+    parser_e.add_argument("--replicates", type=int, default=1, help="\t\tNumber of replicate designs to generate with consecutive seeds (default: 1)", )
+    parser_e.add_argument("--grid", type=str, default=None, help="\t\tTSV file with one design per row: the header has the parameter names or flags (i.e. NIC, ISM, nt, seed) and an optional 'name' column for the output prefix", )
 
     parser_c = subparsers.add_parser("custom", help="\t\tRun in custom mode")
     parser_c.add_argument("-i", "--trans_index", type=str, required=True, help="\t\tFile with transcript information generated with SQANTI-SIM (*_index.tsv)", )
@@ -118,6 +241,8 @@ def design(input: list):
     parser_c.add_argument("--Intergenic", type=int, default=0, help="\t\tNumber of Intergenic to simulate", )
     parser_c.add_argument("-k", "--cores", type=int, default=1, help="\t\tNumber of cores to run in parallel", )
     parser_c.add_argument("-s", "--seed", type=int, default=None, help="\t\tRandomizer seed", )
+    parser_c.add_argument("--replicates", type=int, default=1, help="\t\tNumber of replicate designs to generate with consecutive seeds (default: 1)", )
+    parser_c.add_argument("--grid", type=str, default=None, help="\t\tTSV file with one design per row: the header has the parameter names or flags (i.e. NIC, ISM, nt, seed) and an optional 'name' column for the output prefix", )
 
     parser_s = subparsers.add_parser("sample", help="\t\tRun in sample mode")
     parser_s.add_argument("-i", "--trans_index", type=str, required=True, help="\t\tFile with transcript information generated with SQANTI-SIM (*_index.tsv)", )
@@ -129,7 +254,10 @@ def design(input: list):
     group = parser_s.add_mutually_exclusive_group()
     group.add_argument("--pb_reads", type=str, default=str(), help="\t\tInput PacBio reads for characterization in FASTA or FASTQ format", )
     group.add_argument("--ont_reads", type=str, default=str(), help="\t\tInput ONT reads for characterization in FASTA or FASTQ format", )
-    group.add_argument("--mapped_reads", type=str, default=str(), help="\t\tAligned reads in SAM format", )
+    group.add_argument("--mapped_reads", type=str, default=str(), help="\t\tAligned reads in SAM, BAM or CRAM format", )
+    parser_s.add_argument("--expr_profile", type=str, default=None, help="\t\tExpression profile file (*_expr_profile.json). If it exists the expression values are loaded from it instead of aligning the reads again, otherwise it will be created", )
+    parser_s.add_argument("--cache_dir", type=str, default=transcript_cache.CACHE_DIR, help="\t\tDirectory to cache the transcript sequences extracted from the GTF (default: ~/.cache/sqanti-sim)", )
+    parser_s.add_argument("--stream_align", action="store_true", help="\t\tIf used the reads alignment will be counted directly from the minimap2 output stream without writing the SAM file to disk", )
     parser_s.add_argument("--iso_complex", action="store_true", help="\t\tIf used the program will approximate the expressed isoform complexity (number of isoforms per gene)", )
     parser_s.add_argument("--diff_exp", action="store_true", help="\t\tIf used the program will assign different expression values for novel and known transcripts", )
     parser_s.add_argument("--low_prob", type=float, default=0.1, help="\t\tLow value of prob vector (if --diff_exp)", )
@@ -144,15 +272,15 @@ def design(input: list):
     parser_s.add_argument("--Intergenic", type=int, default=0, help="\t\tNumber of Intergenic to simulate", )
     parser_s.add_argument("-k", "--cores", type=int, default=1, help="\t\tNumber of cores to run in parallel", )
     parser_s.add_argument("-s", "--seed", type=int, default=None, help="\t\tRandomizer seed", )
+    parser_s.add_argument("--replicates", type=int, default=1, help="\t\tNumber of replicate designs to generate with consecutive seeds (default: 1)", )
+    parser_s.add_argument("--grid", type=str, default=None, help="\t\tTSV file with one design per row: the header has the parameter names or flags (i.e. NIC, ISM, nt, seed) and an optional 'name' column for the output prefix", )
     
     args, unknown = parser.parse_known_args(input)
 
     if unknown:
         print("[SQANTI-SIM] design mode unrecognized arguments: {}\n".format(" ".join(unknown)), file=sys.stderr)
 
-    total_novel = sum([args.ISM, args.NIC, args.NNC, args.Fusion, args.Antisense, args.GG, args.GI, args.Intergenic])
-    if args.trans_number is not None and total_novel > args.trans_number:
-        print("[SQANTI-SIM] WARNING: -nt is lower than the novel transcripts to simulate, only novel transcripts will be simulated", file=sys.stderr)
+    check_design_args(args)
 
     if not os.path.isdir(args.dir):
         os.makedirs(args.dir)
@@ -166,6 +294,13 @@ def design(input: list):
     random.seed(args.seed)
     numpy.random.seed(args.seed)
 
+    if args.replicates < 1:
+        print("[SQANTI-SIM] ERROR: --replicates must be greater than 0", file=sys.stderr)
+        sys.exit(1)
+    if args.grid and not os.path.exists(args.grid):
+        print("[SQANTI-SIM] ERROR: --grid file does not exist. Provide a valid path", file=sys.stderr)
+        sys.exit(1)
+
     print("\n[SQANTI-SIM] Running with the following parameters:")
     if args.mode == "equal":
         print("[SQANTI-SIM] - Mode: equal")
@@ -176,13 +311,6 @@ def design(input: list):
         print("[SQANTI-SIM] - N reads:", str(args.read_count))
 
     elif args.mode == "custom":
-        if args.nbn_known < 0 or args.nbn_novel < 0:
-            print("[SQANTI-SIM] ERROR: --nbn_known and --nbn_novel must be greater than 0", file=sys.stderr)
-            sys.exit(1)
-        if args.nbp_known < 0 or args.nbp_known > 1 or args.nbp_novel < 0 or args.nbp_novel > 1:
-            print("[SQANTI-SIM] ERROR: --nbp_known and --nbp_novel must be in the interval [0,1]", file=sys.stderr)
-            sys.exit(1)
-
         print("[SQANTI-SIM] - Mode: custom")
         print("[SQANTI-SIM] - Ref GTF:", str(args.gtf))
         print("[SQANTI-SIM] - Out prefix:", str(args.output))
@@ -194,8 +322,8 @@ def design(input: list):
         print("[SQANTI-SIM] - Novel NB probability:", str(args.nbp_novel))
 
     elif args.mode == "sample":
-        if args.low_prob < 0 or args.low_prob > 1 or args.high_prob < 0 or args.high_prob > 1:
-            print("[SQANTI-SIM] ERROR: --low_prob and --high_prob must be in the interval [0,1]", file=sys.stderr)
+        if not (args.pb_reads or args.ont_reads or args.mapped_reads) and not (args.expr_profile and os.path.exists(args.expr_profile)):
+            print("[SQANTI-SIM] ERROR: provide --pb_reads, --ont_reads, --mapped_reads or an existing --expr_profile", file=sys.stderr)
             sys.exit(1)
 
         print("[SQANTI-SIM] - Mode: sample")
@@ -206,8 +334,15 @@ def design(input: list):
         print("[SQANTI-SIM] - N transcripts:", str(args.trans_number))
         if args.pb_reads:
             print("[SQANTI-SIM] - PacBio reads:", str(args.pb_reads))
-        else:
+        elif args.ont_reads:
             print("[SQANTI-SIM] - ONT reads:", str(args.ont_reads))
+        elif args.mapped_reads:
+            print("[SQANTI-SIM] - Mapped reads:", str(args.mapped_reads))
+        if args.expr_profile:
+            print("[SQANTI-SIM] - Expression profile:", str(args.expr_profile))
+        if args.stream_align:
+            print("[SQANTI-SIM] - Stream alignment: True")
+        print("[SQANTI-SIM] - Cache dir:", str(args.cache_dir))
         print("[SQANTI-SIM] - N threads:", str(args.cores))
 
     print("[SQANTI-SIM] - Seed:", str(args.seed))
@@ -217,24 +352,28 @@ def design(input: list):
         str(args.Antisense), str(args.GG), str(args.GI), str(args.Intergenic)
     ))
 
+    if args.replicates > 1 or args.grid:
+        if args.grid:
+            print("[SQANTI-SIM] - Grid:", str(args.grid))
+        print("[SQANTI-SIM] - Replicates:", str(args.replicates))
+
+        mode_parser = {"equal": parser_e, "custom": parser_c, "sample": parser_s}[args.mode]
+        designs = design_batch_args(parser, mode_parser, input, args)
+        print("\n[SQANTI-SIM][%s] Generating %s designs" %(strftime("%d-%m-%Y %H:%M:%S"), len(designs)))
+        counts_end = design_simulation.batch_design(args, designs)
+
+        for d, d_counts in zip(designs, counts_end):
+            print("[SQANTI-SIM] Design %s (seed %s)" %(d.output, d.seed))
+            design_simulation.summary_table_del(design_simulation.novel_counts(d), d_counts)
+
+        print("[SQANTI-SIM][%s] design step finished" %(strftime("%d-%m-%Y %H:%M:%S")))
+        return
+
     # Modify GTF
     print("\n[SQANTI-SIM][%s] Generating modified GTF" %(strftime("%d-%m-%Y %H:%M:%S")))
     counts_end = design_simulation.simulate_gtf(args)
 
-    counts_ini = defaultdict(
-        lambda: 0,
-        {
-            "full-splice_match": 0,
-            "incomplete-splice_match": args.ISM,
-            "novel_in_catalog": args.NIC,
-            "novel_not_in_catalog": args.NNC,
-            "fusion": args.Fusion,
-            "antisense": args.Antisense,
-            "genic_intron": args.GI,
-            "genic": args.GG,
-            "intergenic": args.Intergenic,
-        },
-    )
+    counts_ini = design_simulation.novel_counts(args)
     design_simulation.summary_table_del(counts_ini, counts_end)
 
     # Generate expression matrix
@@ -278,8 +417,11 @@ def sim(input: list):
     group.add_argument("--ont", action="store_true", help="\t\tIf used the program will simulate ONT reads with NanoSim", )
     parser.add_argument("--illumina", action="store_true", help="\t\tIf used the program will simulate Illumina reads with Polyester", )
     parser.add_argument("--long_count", type=int, default=None, help="\t\tNumber of long reads to simulate (if not given it will use the requested_counts from the --trans_index file)", )
+    parser.add_argument("--fastq", action="store_true", help="\t\tIf used PacBio reads will be written in FASTQ format with simulated qualities (ONT reads are always FASTQ)", )
+    parser.add_argument("--error_profile", action="store_true", help="\t\tIf used NanoSim will also write the error profile of the ONT reads, one line per error (the ground truth of each read is always saved in ONT_simulated_truth.npy)", )
     parser.add_argument("--short_count", type=int, default=None, help="\t\tNumber of short reads to simulate (if not given it will use the requested_counts from the --trans_index file)", )
     parser.add_argument("-s", "--seed", type=int, default=None, help="\t\tRandomizer seed", )
+    parser.add_argument("--cache_dir", type=str, default=transcript_cache.CACHE_DIR, help="\t\tDirectory to cache the transcript sequences extracted from the GTF (default: ~/.cache/sqanti-sim)", )
 
     args, unknown = parser.parse_known_args(input)
 
@@ -300,8 +442,10 @@ def sim(input: list):
     if args.ont:
         print("[SQANTI-SIM] - Platform: ONT")
         print("[SQANTI-SIM] - Read type:", str(args.read_type))
+        print("[SQANTI-SIM] - Error profile:", str(args.error_profile))
     else:
         print("[SQANTI-SIM] - Platform: PacBio")
+        print("[SQANTI-SIM] - Output format:", "FASTQ" if args.fastq else "FASTA")
     
     if args.long_count:
         print("[SQANTI-SIM] - Long reads:", str(args.long_count))
@@ -315,6 +459,7 @@ def sim(input: list):
         else:
             print("[SQANTI-SIM] - Short reads: requested_counts from index file")
 
+    print("[SQANTI-SIM] - Cache dir:", str(args.cache_dir))
     print("[SQANTI-SIM] - N threads:", str(args.cores))
     print("[SQANTI-SIM] - Seed:", str(args.seed))
 
@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+
+# NOTE: this file was added to fit the SQANTI-SIM pipeline
+# Contributor: Jorge Mestre
+#
+# In-process IsoSeqSim normal mode: gtf2gpd -> gpd2fa -> expression matrix ->
+# simulate reads without intermediate files. Transcript sequences are built by
+# the workers from the indexed genome and reads are returned as a stream
+
+import hashlib,re
+import numpy as np
+import pysam
+from multiprocessing import Pool
+from src.IsoSeqSim.utilities import py_isoseqsim_simulate_reads_normal as sim_normal
+from src.IsoSeqSim.utilities.py_isoseqsim_gtf2gpd import extract_iso_info
+
+GATC_COM = str.maketrans("GATC","CTAG")
+DIC_NOGATC_CODE = {"U":["T"],"I":["G"],"R":["A","G"],"Y":["C","T"],"S":["G","C"],"W":["A","T"],"K":["G","T"],"M":["A","C"],"B":["C","G","T"],"D":["A","G","T"],"H":["A","C","T"],"V":["A","C","G"],"N":["A","C","G","T"],"X":["A","C","G","T"]}
+NOGATC_RE = re.compile("[" + "".join(DIC_NOGATC_CODE.keys()) + "]")
+
+def parse_annotation(gtf,expr):
+	# Exon structure of the expressed isoforms in the same order as the gpd file of the normal mode
+	with open(gtf,"r") as gtf_file:
+		dic_iso_info = extract_iso_info(gtf_file)
+	dic_iso_exons = {}
+	for chr_strand in dic_iso_info.keys():
+		chr,strand = chr_strand.split("&")
+		for iso in dic_iso_info[chr_strand].keys():
+			if iso not in expr:
+				continue
+			exon_start_list = sorted(dic_iso_info[chr_strand][iso]["exon_start"])
+			exon_end_list = sorted(dic_iso_info[chr_strand][iso]["exon_end"])
+			dic_iso_exons[iso] = (dic_iso_info[chr_strand][iso]["gene_id"],chr,strand,exon_start_list,exon_end_list)
+	return dic_iso_exons
+
+def init_worker(genome_fa,iso_exons,error_type,error_prob,end5_table,end3_table,seed,quality):
+	# Each process opens its own handle of the genome index
+	global genome,dic_iso_exons
+	genome = pysam.FastaFile(genome_fa)
+	dic_iso_exons = iso_exons
+	sim_normal.init_worker(None,error_type,error_prob,end5_table,end3_table,seed,quality)
+
+def transcript_seq(iso):
+	gene,chr,strand,exon_start_list,exon_end_list = dic_iso_exons[iso]
+	seq = "".join([genome.fetch(chr,start,end) for start,end in zip(exon_start_list,exon_end_list)]).upper()
+
+	# non AGCT nucleotide, resolved with a stream of the transcript
+	ambiguous = [m.start() for m in NOGATC_RE.finditer(seq)]
+	if ambiguous:
+		iso_hash = int(hashlib.md5(iso.encode()).hexdigest(),16)
+		rng = np.random.default_rng([sim_normal.sim_seed,iso_hash])
+		up_seq_list = list(seq)
+		for i in ambiguous:
+			up_seq_list[i] = rng.choice(DIC_NOGATC_CODE[up_seq_list[i]])
+		seq = "".join(up_seq_list)
+
+	if strand == "-": # minus strand, get reverse complementary sequence
+		seq = seq.translate(GATC_COM)[::-1]
+	return seq
+
+def simulate_unit(inputs):
+	sim_reads = []
+	for (iso,first_read,read_count) in inputs:
+		sim_reads.extend(sim_normal.simulate_iso_reads(iso,transcript_seq(iso),first_read,read_count))
+	return sim_reads
+
+def simulate_reads(genome_fa,gtf,expr,n_reads,c5,c3,er_sub,er_ins,er_del,cpu=1,seed=None,output_gpd=None,fastq=False):
+	"""Simulates Iso-Seq reads in normal mode
+
+	Args:
+		genome_fa (str) reference genome FASTA (indexed with faidx or writable to create the index)
+		gtf (str) reference annotation GTF
+		expr (dict) TPM of each transcript to simulate
+		n_reads (int) total number of reads, each transcript gets round(n_reads * TPM / 10^6)
+		c5, c3 (str) 5' and 3' end completeness files
+		er_sub, er_ins, er_del (float) error rates
+		cpu (int) number of processes
+		seed (int) randomizer seed
+		output_gpd (str) if given, gpd file with the read count of each simulated transcript
+		fastq (bool) if True, also simulates the Phred qualities of each read
+
+	Yields:
+		(transcript_id, read_seq, read_qual) of each simulated read, in the same order as the normal mode.
+		Sequences are unwrapped and read_qual is None if fastq is False
+	"""
+
+	error_type,error_prob = sim_normal.extract_error_rate(er_sub,er_ins,er_del)
+	bp5_list,pro5_list,bp3_list,pro3_list = sim_normal.extract_read_completeness(open(c5,"r"),open(c3,"r"))
+	end5_table = sim_normal.compile_completeness(bp5_list,pro5_list)
+	end3_table = sim_normal.compile_completeness(bp3_list,pro3_list)
+	if seed is None:
+		seed = np.random.SeedSequence().entropy
+
+	# Expression matrix
+	mill_reads = n_reads/1000000
+	dic_iso_exons = parse_annotation(gtf,expr)
+	iso_counts = [(iso,int(round(mill_reads * float(expr[iso])))) for iso in dic_iso_exons]
+	iso_lens = {iso:sum(dic_iso_exons[iso][4]) - sum(dic_iso_exons[iso][3]) for iso in dic_iso_exons}
+
+	if output_gpd:
+		with open(output_gpd,"w") as gpd_file:
+			for iso,read_count in iso_counts:
+				gene,chr,strand,exon_start_list,exon_end_list = dic_iso_exons[iso]
+				gpd_file.write("%s\t%s\t%s\t%s\t%s\t%s\t.\t.\t%s\t%s\t%s\t%s\n" % (gene,iso,chr,strand,exon_start_list[0],exon_end_list[-1],len(exon_start_list),(",".join(str(x) for x in exon_start_list) + ","),(",".join(str(x) for x in exon_end_list) + ","),read_count))
+
+	p = Pool(processes=cpu,initializer=init_worker,initargs=(genome_fa,dic_iso_exons,error_type,error_prob,end5_table,end3_table,seed,fastq))
+	units = sim_normal.make_units([x for x in iso_counts if x[1] > 0],iso_lens,sim_normal.UNIT_BASES)
+	for res in p.imap(func=simulate_unit,iterable=units,chunksize=1):
+		for read_seq,iso,read_qual in res:
+			yield iso,read_seq,read_qual
+	p.close()
+	p.join()
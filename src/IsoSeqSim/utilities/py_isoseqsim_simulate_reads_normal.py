@@ -3,23 +3,32 @@
 # NOTE: this file was modified to fit the SQANTI-SIM pipeline
 # Contributor: Jorge Mestre
 
-import sys,time,argparse
+import sys,time,argparse,hashlib
 import numpy as np
 from multiprocessing import cpu_count,Pool
 from collections import defaultdict
 
+UNIT_BASES = 2000000 # Expected bases simulated in each worker task (Modified for SQANTI-SIM)
+
 def main(args):
 	sys.stdout.write("Start analysis: " + time.strftime("%a,%d %b %Y %H:%M:%S") + "\n")
 	sys.stdout.flush()
 	error_type,error_prob = extract_error_rate(args.er_sub,args.er_ins,args.er_del)
 	bp5_list,pro5_list,bp3_list,pro3_list = extract_read_completeness(args.cpt_5end,args.cpt_3end)
+	# End-completeness tables compiled once as cumulative probabilities (Modified for SQANTI-SIM)
+	end5_table = compile_completeness(bp5_list,pro5_list)
+	end3_table = compile_completeness(bp3_list,pro3_list)
 	input_gpd_fl = args.input_gpd
 	#output_gpd_fl = args.output
 	output_fasta_fl = open(args.output + ".fasta", "w")
 	dic_iso_seq,iso_list = parse_transcriptome_fa(args.input_fa)
-	p = Pool(processes=args.cpu)
-	csize = 100
-	results = p.imap(func=generate_simulated_reads,iterable=generate_tx(input_gpd_fl,dic_iso_seq,iso_list,error_type,error_prob,bp5_list,pro5_list,bp3_list,pro3_list),chunksize=csize)
+	# Transcript sequences and error model are given once to each worker, tasks only carry the transcript ID and read count (Modified for SQANTI-SIM)
+	# Each read has its own random stream from (seed, transcript, read index), so the output does not depend on --cpu (Modified for SQANTI-SIM)
+	seed = args.seed if args.seed is not None else np.random.SeedSequence().entropy
+	p = Pool(processes=args.cpu,initializer=init_worker,initargs=(dic_iso_seq,error_type,error_prob,end5_table,end3_table,seed))
+	# Tasks are balanced by expected bases (reads x length), highly expressed transcripts are split in several tasks (Modified for SQANTI-SIM)
+	csize = 1
+	results = p.imap(func=generate_simulated_reads,iterable=generate_tx(input_gpd_fl,dic_iso_seq,UNIT_BASES),chunksize=csize)
 	
 	# Write in fasta format (Modified for SQANTI-SIM)
 	n_reads = 0
@@ -31,7 +40,7 @@ def main(args):
 			seq = str(read[0])
 			id = str(read[1])
 			id = id + '_PacBio_simulated_read_' + str(n_reads)
-			output_fasta_fl.write(">" + id + "\n" + seq + "\n")
+			output_fasta_fl.write(">" + id + "\n" + wrap_seq(seq) + "\n")
 			n_reads += 1
 
 	output_fasta_fl.close()
@@ -48,20 +57,55 @@ def extract_error_rate(err_sub,err_ins,err_del):
 		error_prob = [(1.0-(err_sub + err_ins + err_del)),err_sub,err_ins,err_del]
 	return error_type,error_prob
 
-def mutate_read(read_seq,error_type,error_prob):
-	read_seq = read_seq.upper()
+# Nucleotides as uint8 codes for the vectorized error model (Modified for SQANTI-SIM)
+NUC = np.frombuffer(b"ACGT",dtype=np.uint8)
+NUC_IDX = np.zeros(256,dtype=np.uint8)
+NUC_IDX[NUC] = np.arange(4,dtype=np.uint8)
 
-	dic_error_no = {"A":"A","C":"C","G":"G","T":"T"}
-	dic_error_sub = {"A":np.random.choice(["C","G","T"]),"C":np.random.choice(["A","G","T"]),"G":np.random.choice(["A","C","T"]),"T":np.random.choice(["A","C","G"])}
-	dic_error_ins = {"A":"A"+np.random.choice(["A","C","G","T"]),"C":"C"+np.random.choice(["A","C","G","T"]),"G":"G"+np.random.choice(["A","C","G","T"]),"T":"T"+np.random.choice(["A","C","G","T"])}
-	dic_error_del = {"A":"","C":"","G":"","T":""}
+def iso_keys(seed,iso):
+	# Philox keys from (seed, transcript) for the reads and for the 5'/3' end completeness (Modified for SQANTI-SIM)
+	iso_hash = int(hashlib.md5(iso.encode()).hexdigest(),16)
+	state = np.random.SeedSequence([seed,iso_hash]).generate_state(4,np.uint64)
+	return state[:2],state[2:]
 
-	dic_error = {"no":dic_error_no,"sub":dic_error_sub,"ins":dic_error_ins,"del":dic_error_del}
-	read_seq_new = ""
-	for nuc in read_seq:
-		nuc_new = dic_error[np.random.choice(error_type,p=error_prob)][nuc]
-		read_seq_new += nuc_new
-	return read_seq_new
+def read_rng(key):
+	# The read index is set as the high word of the counter (Modified for SQANTI-SIM)
+	return lambda read_idx: np.random.Generator(np.random.Philox(counter=[0,0,0,read_idx],key=key))
+
+def end_uniforms(key,first_read,read_count):
+	# Read i takes the values 2i and 2i+1 of the end completeness stream of its transcript, so the uniforms of a
+	# block of reads are drawn in one call after advancing the counter, 4 values per step (Modified for SQANTI-SIM)
+	bitgen = np.random.Philox(key=key)
+	offset = 2 * first_read
+	bitgen.advance(offset // 4)
+	u = np.random.Generator(bitgen).random(offset % 4 + 2 * read_count)[offset % 4:]
+	return u.reshape(-1,2)
+
+def mutate_read(read_seq,error_type,error_prob,rng):
+	# All the per-base error events of the read are drawn in a single call and
+	# the mutated read is assembled in a uint8 buffer (Modified for SQANTI-SIM)
+	seq = np.frombuffer(read_seq.upper().encode(),dtype=np.uint8)
+	if len(seq) == 0:
+		return ""
+	events = rng.choice(len(error_type),size=len(seq),p=error_prob)
+	is_sub = events == error_type.index("sub")
+	is_ins = events == error_type.index("ins")
+	is_del = events == error_type.index("del")
+
+	# Substitution: any of the other 3 nucleotides
+	nuc_new = seq.copy()
+	nuc_new[is_sub] = NUC[(NUC_IDX[seq[is_sub]] + rng.integers(1,4,size=np.count_nonzero(is_sub))) % 4]
+
+	# Each base writes 1 (no, sub), 2 (ins: base + random nucleotide) or 0 (del) bases
+	out_len = np.ones(len(seq),dtype=np.int64)
+	out_len[is_ins] = 2
+	out_len[is_del] = 0
+	out_end = np.cumsum(out_len)
+	read_seq_new = np.empty(out_end[-1],dtype=np.uint8)
+	keep = ~is_del
+	read_seq_new[out_end[keep] - out_len[keep]] = nuc_new[keep]
+	read_seq_new[out_end[is_ins] - 1] = NUC[rng.integers(0,4,size=np.count_nonzero(is_ins))]
+	return read_seq_new.tobytes().decode()
 
 def extract_read_completeness(pro_fl_5end,pro_fl_3end):
 	bp5_list = []
@@ -94,9 +138,20 @@ def extract_read_completeness(pro_fl_5end,pro_fl_3end):
 	pro_fl_3end.close()
 	return bp5_list,pro5_list,bp3_list,pro3_list
 
-def mutate_read_ends(read_seq,bp5_list,pro5_list,bp3_list,pro3_list):
-	del5 = np.random.choice(bp5_list,p=pro5_list)
-	del3 = np.random.choice(bp3_list,p=pro3_list)
+def compile_completeness(bp_list,pro_list):
+	# Deleted nucleotides and cumulative probabilities to sample with searchsorted (Modified for SQANTI-SIM)
+	bp_table = np.array(bp_list,dtype=np.int64)
+	cdf_table = np.cumsum(pro_list)
+	cdf_table[-1] = 1.0
+	return bp_table,cdf_table
+
+def sample_completeness(table,u):
+	# Deleted nucleotides for a batch of reads given one uniform value per read (Modified for SQANTI-SIM)
+	bp_table,cdf_table = table
+	idx = np.minimum(np.searchsorted(cdf_table,u,side="right"),len(bp_table)-1)
+	return bp_table[idx]
+
+def mutate_read_ends(read_seq,del5,del3):
 	if del5 == 0:
 		if del3 == 0:
 			read_seq_new = read_seq
@@ -127,47 +182,95 @@ def parse_transcriptome_fa(iso_fa_fl):
 	iso_fa_fl.close()
 	return dic_iso_seq,iso_list
 
+# Phred qualities of the FASTQ output: per-read mean from the overall error rate and per-base normal noise (Modified for SQANTI-SIM)
+READ_QUAL_SD = 2.0
+BASE_QUAL_SD = 4.0
+MAX_QUAL = 93
+
+def error_qual(error_prob):
+	return -10 * np.log10(max(1.0 - error_prob[0],1e-9))
+
+def simulate_quality(read_len,rng):
+	# All the qualities of a read drawn at once and encoded as Phred+33 bytes (Modified for SQANTI-SIM)
+	read_qual = rng.normal(mean_qual,READ_QUAL_SD)
+	qual = np.clip(np.rint(rng.normal(read_qual,BASE_QUAL_SD,size=read_len)),1,MAX_QUAL).astype(np.uint8)
+	return (qual + 33).tobytes().decode("ascii")
+
+def wrap_seq(read_seq,width=80):
+	return "\n".join([read_seq[j:j+width] for j in range(0,len(read_seq),width)])
+
+def init_worker(iso_seq,err_type,err_prob,end5,end3,seed,quality=False):
+	global dic_iso_seq,error_type,error_prob,end5_table,end3_table,sim_seed,sim_quality,mean_qual
+	dic_iso_seq = iso_seq
+	error_type,error_prob = err_type,err_prob
+	end5_table,end3_table = end5,end3
+	sim_seed = seed
+	sim_quality = quality
+	mean_qual = error_qual(err_prob)
+
+def simulate_iso_reads(iso,read_seq,first_read,read_count):
+	# Simulates reads first_read..first_read+read_count-1 of one transcript (Modified for SQANTI-SIM)
+	sim_reads = []
+	read_key,end_key = iso_keys(sim_seed,iso)
+	iso_rng = read_rng(read_key)
+	rngs = [iso_rng(i) for i in range(first_read,first_read+int(read_count))]
+
+	# 5'/3' truncations of all the reads of the transcript sampled at once
+	u = end_uniforms(end_key,first_read,int(read_count))
+	del5_list = sample_completeness(end5_table,u[:,0])
+	del3_list = sample_completeness(end3_table,u[:,1])
+
+	# Reads are returned unwrapped, with their qualities if requested (Modified for SQANTI-SIM)
+	for rng,del5,del3 in zip(rngs,del5_list,del3_list):
+		read_seq_muta = mutate_read(read_seq,error_type,error_prob,rng)
+		read_seq_muta_end = mutate_read_ends(read_seq_muta,del5,del3)
+
+		if read_seq_muta_end == "": # If mutating start/end deletes read, sim whole transcript (Modified for SQANTI-SIM)
+			read_seq_muta_end = read_seq_muta
+
+		if read_seq_muta_end != "":
+			read_qual = simulate_quality(len(read_seq_muta_end),rng) if sim_quality else None
+			sim_reads.append((read_seq_muta_end, iso, read_qual))
+	return sim_reads
+
 def generate_simulated_reads(inputs):
-	(line,z,dic_iso_seq,iso_list,error_type,error_prob,bp5_list,pro5_list,bp3_list,pro3_list) = inputs
-	gene,iso,chrom,strand,tss,tts,cds_tss,cds_tts,exon_count,exon_start_set,exon_end_set,read_count = line.rstrip("\n").split("\t")
-	lr_idx = 0
-	if int(read_count) != 0:
-		read_seq = dic_iso_seq[iso]
-		#simu_fa_all_lines_list = []
-		sim_reads = []
-		for i in range(0,int(read_count)):
-			simu_fa_seq_line_list = []
-			read_seq_muta = mutate_read(read_seq,error_type,error_prob)
-			read_seq_muta_end = mutate_read_ends(read_seq_muta,bp5_list,pro5_list,bp3_list,pro3_list)
-
-			if read_seq_muta_end == "": # If mutating start/end deletes read, sim whole transcript (Modified for SQANTI-SIM)
-				read_seq_muta_end = read_seq_muta
-
-			if read_seq_muta_end != "":
-				lr_idx += 1
-				#simu_fa_name_line = ">LR" + str(iso_list.index(iso)+1) + "." + str(lr_idx) + " " + iso + "\n"
-				for j in range(0,len(read_seq_muta_end),80):
-					simu_fa_seq_line_list.append(read_seq_muta_end[j:j+80])
-				#simu_fa_line = simu_fa_name_line + "\n".join(simu_fa_seq_line_list)
-				#simu_fa_all_lines_list.append(simu_fa_line)
-				simu_fa_line = "\n".join(simu_fa_seq_line_list)
-				sim_reads.append((simu_fa_line, iso))
-
-		#if simu_fa_all_lines_list != []:
-			#simu_fa_all_lines = "\n".join(simu_fa_all_lines_list)
-			#return simu_fa_all_lines
-		if sim_reads != []:
-			return sim_reads		
-		else:
-			return None
+	# Simulates one work unit: a list of (transcript, first read index, number of reads) (Modified for SQANTI-SIM)
+	sim_reads = []
+	for (iso,first_read,read_count) in inputs:
+		sim_reads.extend(simulate_iso_reads(iso,dic_iso_seq[iso],first_read,read_count))
+
+	if sim_reads != []:
+		return sim_reads
 	else:
 		return None
 
-def generate_tx(input_fl,dic_iso_seq,iso_list,error_type,error_prob,bp5_list,pro5_list,bp3_list,pro3_list):
-	z = 0
+def make_units(iso_counts,iso_lens,unit_bases):
+	# Packs the requested reads in units of ~unit_bases expected bases, splitting transcripts with many reads (Modified for SQANTI-SIM)
+	unit = []
+	unit_size = 0
+	for iso,read_count in iso_counts:
+		iso_len = max(iso_lens[iso],1)
+		first_read = 0
+		while read_count > 0:
+			n = min(read_count,max(1,(unit_bases - unit_size) // iso_len))
+			unit.append((iso,first_read,n))
+			unit_size += n * iso_len
+			first_read += n
+			read_count -= n
+			if unit_size + iso_len > unit_bases:
+				yield unit
+				unit = []
+				unit_size = 0
+	if unit:
+		yield unit
+
+def generate_tx(input_fl,dic_iso_seq,unit_bases):
+	iso_counts = []
 	for line in input_fl:
-		z += 1
-		yield (line,z,dic_iso_seq,iso_list,error_type,error_prob,bp5_list,pro5_list,bp3_list,pro3_list)
+		gene,iso,chrom,strand,tss,tts,cds_tss,cds_tts,exon_count,exon_start_set,exon_end_set,read_count = line.rstrip("\n").split("\t")
+		iso_counts.append((iso,int(read_count)))
+	iso_lens = {iso:len(dic_iso_seq[iso]) for iso,read_count in iso_counts}
+	return make_units(iso_counts,iso_lens,unit_bases)
 
 def do_inputs():
 	parser = argparse.ArgumentParser(description="Genereate simulate reads.", formatter_class=argparse.ArgumentDefaultsHelpFormatter)
@@ -181,6 +284,7 @@ def do_inputs():
 	parser.add_argument('-i','--er_ins',type=float,default=0.025,help="Error rate: insertion")
 	parser.add_argument('-d','--er_del',type=float,default=0.025,help="Error rate: deletion")
 	parser.add_argument('-p','--cpu',type=int,default=cpu_count(),help="Number of threads")
+	parser.add_argument('--seed',type=int,default=None,help="Randomizer seed")
 	args = parser.parse_args()
 	return args
 
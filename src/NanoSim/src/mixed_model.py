@@ -77,7 +77,24 @@ def wei_geom(lam, k, prob, weight):
     return value
 
 
-def trunc_lognorm_rvs(error_type, read_type, basecaller, n):
+def pois_geom_rvs(lam, prob, weight, n):
+    # Draw n random numbers from Poisson-Geometric distribution at once
+    value = np.random.geometric(prob, n)
+    is_pois = np.random.random(n) < weight
+    value[is_pois] = np.random.poisson(lam, np.count_nonzero(is_pois)) + 1
+    return value
+
+
+def wei_geom_rvs(lam, k, prob, weight, n):
+    # Draw n random numbers from Weibull-Geometric distribution at once
+    value = np.random.geometric(prob, n) - 1
+    is_wei = np.random.random(n) < weight
+    value[is_wei] = np.ceil(lam * np.random.weibull(k, np.count_nonzero(is_wei)))
+    value[value == 0] = 1
+    return value
+
+
+def trunc_lognorm_params(error_type, read_type, basecaller):
     if basecaller == "albacore":
         a = 1
         b = 28
@@ -181,6 +198,24 @@ def trunc_lognorm_rvs(error_type, read_type, basecaller, n):
                 mean = 1.2635415
                 sd = 0.9008419
 
-    m = exp(mean)
-    truncln_gen = trunc_lognorm_gen(name="truncln", a=a, b=b, shapes="s, m")
-    return truncln_gen.rvs(s=sd, m=m, size=n)
+    return a, b, mean, sd
+
+
+# Discrete CDF of the truncated log-normal qualities, built once per (basecaller, read_type, error_type)
+trunc_lognorm_cdf_tables = {}
+
+
+def trunc_lognorm_cdf(error_type, read_type, basecaller):
+    # Entry i is P(quality <= a + i), same distribution as trunc_lognorm_gen.rvs: floor of the truncated ppf
+    key = (basecaller, read_type, error_type)
+    if key not in trunc_lognorm_cdf_tables:
+        a, b, mean, sd = trunc_lognorm_params(error_type, read_type, basecaller)
+        lncdf = lognorm.cdf(np.arange(a, b + 1), sd, scale=exp(mean))
+        trunc_lognorm_cdf_tables[key] = (a, (lncdf[1:] - lncdf[0]) / (lncdf[-1] - lncdf[0]))
+    return trunc_lognorm_cdf_tables[key]
+
+
+def trunc_lognorm_rvs(error_type, read_type, basecaller, n):
+    # Inverse transform sampling of n qualities from the precomputed CDF
+    a, cdf = trunc_lognorm_cdf(error_type, read_type, basecaller)
+    return a + np.searchsorted(cdf, np.random.random(n), side="right")
@@ -14,6 +14,7 @@ from __future__ import print_function
 from __future__ import with_statement
 
 import multiprocessing as mp
+import hashlib
 from subprocess import call
 from textwrap import dedent
 import sys
@@ -23,7 +24,11 @@ import pysam
 import random
 import re
 import copy
+from collections import OrderedDict
+from bisect import bisect_left, bisect_right
 import argparse
+import io
+import shutil
 import joblib
 from time import strftime
 from urllib.request import Request, urlopen
@@ -34,8 +39,10 @@ import scipy.stats
 if sys.version_info[0] < 3:
     from string import maketrans
     trantab = maketrans("T", "U")
+    comptab = maketrans("ATCG", "TAGC")
 else:
     trantab = str.maketrans("T", "U")
+    comptab = str.maketrans("ATCG", "TAGC")
 
 try:
     from six.moves import xrange
@@ -52,12 +59,40 @@ AUTHOR = "Chen Yang, Saber Hafezqorani, Ka Ming Nip, and Theodora Lo (UBC & BCGS
 CONTACT = "cheny@bcgsc.ca; shafezqorani@bcgsc.ca; kmnip@bcgsc.ca"
 
 BASES = ['A', 'T', 'C', 'G']
-
-
-def check_print_progress(sequence_index):
-    if sequence_index % 10000 == 0:
-        sys.stdout.write(strftime("%Y-%m-%d %H:%M:%S") + ": Number of reads simulated >> " +
-                         str(sequence_index + 1) + "\r")
+BASES_ARRAY = np.frombuffer("".join(BASES).encode(), dtype=np.uint8)  # Bases as uint8 codes (Modified for SQANTI-SIM)
+BASES_IDX = np.zeros(256, dtype=np.uint8)
+BASES_IDX[BASES_ARRAY] = np.arange(4, dtype=np.uint8)
+KDE_POOL_SIZE = 1000  # Initial samples of the 2D length KDE in each pool (Modified for SQANTI-SIM)
+KDE_POOL_MAX = 64000  # Samples of a pool at sparse lengths of the KDE (Modified for SQANTI-SIM)
+KDE_POOL_READS = 10  # Reads of a transcript that share a pool of KDE samples (Modified for SQANTI-SIM)
+KDE_POOL_CACHE = 16  # Pools kept in memory by each process (Modified for SQANTI-SIM)
+PROGRESS_STEP = 10000  # Reads simulated by a worker between progress updates (Modified for SQANTI-SIM)
+ERROR_BLOCK_LEN = 8  # Reference bases per pre-drawn error event in error_list (Modified for SQANTI-SIM)
+MERGE_CHUNK = 1 << 20  # Bytes per copy when merging the subfiles of the workers (Modified for SQANTI-SIM)
+TRUTH_BATCH = 10000  # Reads per batch written to the ground truth store (Modified for SQANTI-SIM)
+
+
+def seed_stream(seed, *key):
+    # Reseeds random and np.random from (seed, key), i.e. (seed, transcript, read index), so each read is simulated
+    # with its own random stream whatever process simulates it (Modified for SQANTI-SIM)
+    entropy = [seed]
+    for k in key:
+        if isinstance(k, str):
+            k = int(hashlib.md5(k.encode()).hexdigest(), 16)
+        entropy.append(k)
+    state = np.random.SeedSequence(entropy).generate_state(4)
+    np.random.seed(state)
+    random.seed(int.from_bytes(state.tobytes(), "little"))
+
+
+def check_print_progress(simulated):
+    # Workers add their reads to the shared counter every PROGRESS_STEP reads, so the lock is rarely taken
+    # (Modified for SQANTI-SIM)
+    if simulated % PROGRESS_STEP == 0:
+        with total_simulated.get_lock():
+            total_simulated.value += PROGRESS_STEP
+            total = total_simulated.value
+        sys.stdout.write(strftime("%Y-%m-%d %H:%M:%S") + ": Number of reads simulated >> " + str(total) + "\r")
         sys.stdout.flush()
 
 
@@ -110,10 +145,67 @@ def ref_len_from_structure(input):
     return l
 
 
-def select_nearest_kde2d(sampled_2d_lengths, ref_len_total):
-    fc = sampled_2d_lengths[:, 0]
-    idx = np.abs(fc - ref_len_total).argmin()
-    return int(sampled_2d_lengths[idx][1])
+kde_pools = OrderedDict()
+
+
+def kde_window(fc, ref_len_total):
+    # Distance from ref_len_total to the KDE_POOL_READS-th nearest reference length of a sorted pool (Modified for
+    # SQANTI-SIM)
+    i = int(np.searchsorted(fc, ref_len_total))
+    near = np.sort(np.abs(fc[max(i - KDE_POOL_READS, 0):i + KDE_POOL_READS] - ref_len_total))
+    return near[min(KDE_POOL_READS, len(near)) - 1]
+
+
+def get_kde_pool(seed, ref_trx, ref_len_total, block, refill):
+    # Sample of the 2D length KDE sorted by reference length, drawn from its own random stream so it is the same in
+    # every process. The pool starts with KDE_POOL_SIZE samples and is doubled, up to KDE_POOL_MAX, while the
+    # samples for the reads of the block are farther than the KDE bandwidth from ref_len_total, so reads at sparse
+    # lengths of the model are not taken from a wide window. Recently used pools are cached (Modified for SQANTI-SIM)
+    key = (ref_trx, block, refill)
+    if key in kde_pools:
+        kde_pools.move_to_end(key)
+        return kde_pools[key]
+
+    bandwidth = float(getattr(kde_aligned_2d, "bandwidth_", kde_aligned_2d.bandwidth))
+    seed_stream(seed, ref_trx, "kde", block, refill)
+    sampled_2d_lengths = get_length_kde(kde_aligned_2d, KDE_POOL_SIZE, False, False)
+    sampled_2d_lengths = sampled_2d_lengths[np.argsort(sampled_2d_lengths[:, 0], kind="stable")]
+    chunk = 0
+    while len(sampled_2d_lengths) < KDE_POOL_MAX and \
+            kde_window(sampled_2d_lengths[:, 0], ref_len_total) > bandwidth:
+        chunk += 1
+        seed_stream(seed, ref_trx, "kde", block, refill, chunk)
+        sampled_2d_lengths = np.concatenate(
+            (sampled_2d_lengths, get_length_kde(kde_aligned_2d, len(sampled_2d_lengths), False, False)))
+        sampled_2d_lengths = sampled_2d_lengths[np.argsort(sampled_2d_lengths[:, 0], kind="stable")]
+    kde_pools[key] = (sampled_2d_lengths[:, 0], sampled_2d_lengths[:, 1].astype(int).tolist())
+    if len(kde_pools) > KDE_POOL_CACHE:
+        kde_pools.popitem(last=False)
+    return kde_pools[key]
+
+
+def select_nearest_kde2d(seed, ref_trx, trx_read, ref_len_total, max_len=None):
+    # Aligned length of read trx_read of a transcript (Modified for SQANTI-SIM). Each block of KDE_POOL_READS reads
+    # shares a pool and takes its samples nearest to ref_len_total in order, without replacement; if max_len is given
+    # samples not shorter than max_len are skipped. When a pool is used up, a new one is drawn
+    block, k = divmod(trx_read, KDE_POOL_READS)
+    refill = 0
+    while True:
+        fc, aligned = get_kde_pool(seed, ref_trx, ref_len_total, block, refill)
+        right = int(np.searchsorted(fc, ref_len_total))
+        left = right - 1
+        while left >= 0 or right < len(aligned):
+            if right == len(aligned) or (left >= 0 and ref_len_total - fc[left] <= fc[right] - ref_len_total):
+                idx = left
+                left -= 1
+            else:
+                idx = right
+                right += 1
+            if max_len is None or aligned[idx] < max_len:
+                if k == 0:
+                    return aligned[idx]
+                k -= 1
+        refill += 1
 
 
 def update_structure(ref_trx_structure, IR_markov_model):
@@ -246,11 +338,51 @@ def get_length_kde(kde, num, log=False, flatten=True):
     return tmp_list
 
 
+class IndexedFasta(object):
+    # Indexed FASTA read on demand instead of loaded in memory (Modified for SQANTI-SIM)
+    # Only the lengths are kept, shared by the forked workers, and each process opens its own faidx handle
+    def __init__(self, fasta, names=None):
+        self.fasta = fasta
+        handle = pysam.FastaFile(fasta)  # Creates the .fai index if missing
+        self.lengths = OrderedDict()
+        for name, length in zip(handle.references, handle.lengths):
+            if names is None or name in names:
+                self.lengths[name] = length
+        handle.close()
+        self.references = list(self.lengths.keys())
+        self.handle = None
+        self.pid = None
+
+    def fetch(self, name, start=None, end=None):
+        if self.pid != os.getpid():
+            self.handle = pysam.FastaFile(self.fasta)
+            self.pid = os.getpid()
+        return self.handle.fetch(name, start, end)
+
+
+def read_expression(exp):
+    # TPM of the transcripts with positive expression (Modified for SQANTI-SIM)
+    dict_exp = {}
+    with open(exp, 'r') as exp_file:
+        header = exp_file.readline()
+        for line in exp_file:
+            parts = line.split("\t")
+            if len(parts) < 3:
+                sys.stderr.write("Expression profile must contain 3 columns: ID, count, TPM \n")
+                sys.exit(1)
+            #transcript_id = parts[0].split(".")[0]
+            transcript_id = parts[0]
+            tpm = float(parts[2])
+            if tpm > 0:
+                dict_exp[transcript_id] = tpm
+    return dict_exp
+
+
 def read_profile(ref_g, number_list, model_prefix, per, mode, strandness, ref_t=None, dna_type=None, abun=None,
                  polya=None, exp=None, model_ir=False, chimeric=False):
     # Note var number_list (list) used to be number (int)
     global number_aligned_l, number_unaligned_l, number_segment_list
-    global match_ht_list, error_par, trans_error_pr, match_markov_model
+    global match_ht_list, error_par, trans_error_pr, match_markov_model, error_model
     global kde_aligned, kde_ht, kde_ht_ratio, kde_unaligned, kde_aligned_2d
     global seq_dict, seq_len, max_chrom
     global strandness_rate
@@ -273,6 +405,14 @@ def read_profile(ref_g, number_list, model_prefix, per, mode, strandness, ref_t=
         global dict_exp, ecdf_length_list, ecdf_weight_list
         ref = ref_t
 
+        # Expression is read first so that only the expressed transcripts are indexed (Modified for SQANTI-SIM)
+        sys.stdout.write(strftime("%Y-%m-%d %H:%M:%S") + ": Read in expression profile\n")
+        sys.stdout.flush()
+        dict_exp = read_expression(exp)
+        if len(dict_exp) == 0:
+            sys.stderr.write("Expression profile contains no TPM values > 0\n")
+            sys.exit(1)
+
     if strandness is None:
         with open(model_prefix + "_strandness_rate", 'r') as strand_profile:
             strandness_rate = float(strand_profile.readline().split("\t")[1])
@@ -342,6 +482,11 @@ def read_profile(ref_g, number_list, model_prefix, per, mode, strandness, ref_t=
                         sys.stderr.write("You didn't provide a reference genome for " + species + '\n')
                         sys.exit(1)
                     dict_dna_type[species][chr_name.split(".")[0]] = type
+    elif mode == "transcriptome":
+        # Sequences of the expressed transcripts are fetched from the faidx index when needed (Modified for SQANTI-SIM)
+        seq_dict = IndexedFasta(ref, dict_exp)
+        seq_len = seq_dict.lengths
+        max_chrom = max(seq_len.values(), default=0)
     else:
         max_chrom = 0
         with open(ref, 'r') as infile:
@@ -387,24 +532,6 @@ def read_profile(ref_g, number_list, model_prefix, per, mode, strandness, ref_t=
                     multi_dict_abun[samples[s_idx]][species] = expected[s_idx]
 
     else:
-        sys.stdout.write(strftime("%Y-%m-%d %H:%M:%S") + ": Read in expression profile\n")
-        sys.stdout.flush()
-        dict_exp = {}
-        with open(exp, 'r') as exp_file:
-            header = exp_file.readline()
-            for line in exp_file:
-                parts = line.split("\t")
-                if len(parts) < 3:
-                    sys.stderr.write("Expression profile must contain 3 columns: ID, count, TPM \n")
-                    sys.exit(1)
-                #transcript_id = parts[0].split(".")[0]
-                transcript_id = parts[0]
-                tpm = float(parts[2])
-                if tpm > 0:
-                    dict_exp[transcript_id] = tpm
-        if len(dict_exp) == 0:
-            sys.stderr.write("Expression profile contains no TPM values > 0\n")
-            sys.exit(1)
         # create the ecdf dict considering the expression profiles
         ecdf_length_list, ecdf_weight_list = make_cdf(dict_exp, seq_len)
 
@@ -412,8 +539,8 @@ def read_profile(ref_g, number_list, model_prefix, per, mode, strandness, ref_t=
             global genome_fai, IR_markov_model, dict_ref_structure
             sys.stdout.write(strftime("%Y-%m-%d %H:%M:%S") + ": Read in reference genome and create .fai index file\n")
             sys.stdout.flush()
-            # create and read the .fai file of the reference genome
-            genome_fai = pysam.Fastafile(ref_g)
+            # create and read the .fai file of the reference genome, opened again by each worker (Modified for SQANTI-SIM)
+            genome_fai = IndexedFasta(ref_g)
 
             sys.stdout.write(strftime("%Y-%m-%d %H:%M:%S") + ": Read in IR markov model\n")
             sys.stdout.flush()
@@ -508,6 +635,8 @@ def read_profile(ref_g, number_list, model_prefix, per, mode, strandness, ref_t=
         with open(model_prefix + "_match_markov_model", 'r') as mm_profile:
             match_markov_model = read_ecdf(mm_profile)
 
+        error_model = compile_error_model(match_markov_model, match_ht_list, error_par, trans_error_pr)
+
         # Read length of unaligned reads
         sys.stdout.write(strftime("%Y-%m-%d %H:%M:%S") + ": Read KDF of unaligned reads\n")
         sys.stdout.flush()
@@ -583,94 +712,76 @@ def add_abundance_var(expected_abun, total_len, var_low, var_high):
 
 
 def mutate_homo(seq, base_quals, k, basecaller, read_type):
-    hp_arr = []  # [[base, start, end], ...]
-    hp_length_hist = {}  # {length: {A/T: count, C/G: count} ...}
-    hp_samples = {}  # {length: {A/T: [sample], C/G: [sample]} ...}
+    # Homopolymers are mutated in one pass over the sequence segments, the size, mismatch and quality draws of all
+    # the homopolymers are done at once (Modified for SQANTI-SIM)
 
     # Finding homopolymers in sequence
     pattern = "A{" + re.escape(str(k)) + ",}|C{" + re.escape(str(k)) + ",}|G{" + re.escape(
         str(k)) + ",}|T{" + re.escape(str(k)) + ",}"
 
-    for match in re.finditer(pattern, seq):
-        hp_start = match.start()
-        hp_end = match.end()
-        length = hp_end - hp_start
-        base = match.group()[0]
-        hp_arr.append([base, hp_start, hp_end])
-        if length not in hp_length_hist.keys():
-            hp_length_hist[length] = {"A": 0, "T": 0, "C": 0, "G": 0}
-
-        hp_length_hist[length][base] += 1
-
-    # Obtaining samples from normal distributions
-    for length in hp_length_hist.keys():
-        hp_samples[length] = {}
-        a_mu, a_sigma, t_mu, t_sigma, c_mu, c_sigma, g_mu, g_sigma = nd.get_nd_par(length, read_type, basecaller)
-
-        if hp_length_hist[length]["A"] > 0:
-            hp_samples[length]["A"] = np.random.normal(a_mu, a_sigma, hp_length_hist[length]["A"])
-        if hp_length_hist[length]["T"] > 0:
-            hp_samples[length]["T"] = np.random.normal(t_mu, t_sigma, hp_length_hist[length]["T"])
-        if hp_length_hist[length]["C"] > 0:
-            hp_samples[length]["C"] = np.random.normal(c_mu, c_sigma, hp_length_hist[length]["C"])
-        if hp_length_hist[length]["G"] > 0:
-            hp_samples[length]["G"] = np.random.normal(g_mu, g_sigma, hp_length_hist[length]["G"])
-
-    for length in hp_samples.keys():
-        for base in hp_samples[length].keys():
-            hp_samples[length][base] = [0 if x < 0 else x for x in hp_samples[length][base]]
-
-    # Mutating homopolymers in given sequence
-    last_pos = 0
-    mutated_seq = ""
-    total_hp_size_change = 0
-    mis_rate = nd.get_hpmis_rate(read_type, basecaller)
-    for hp_info in hp_arr:
-        base = hp_info[0]
-        ref_hp_start = hp_info[1]
-        ref_hp_end = hp_info[2]
+    hp_arr = [(match.group()[0], match.start(), match.end()) for match in re.finditer(pattern, seq)]
+    if len(hp_arr) == 0:
+        return seq, base_quals
 
-        size = int(round(hp_samples[ref_hp_end - ref_hp_start][base][-1]))
-        hp_samples[ref_hp_end - ref_hp_start][base] = hp_samples[ref_hp_end - ref_hp_start][base][:-1]
+    # Obtaining samples from normal distributions, parameters in the order of BASES
+    nd_par = {}
+    hp_mu = np.empty(len(hp_arr))
+    hp_sigma = np.empty(len(hp_arr))
+    for i, (base, hp_start, hp_end) in enumerate(hp_arr):
+        length = hp_end - hp_start
+        if length not in nd_par:
+            nd_par[length] = nd.get_nd_par(length, read_type, basecaller)
+        j = BASES.index(base)
+        hp_mu[i] = nd_par[length][2 * j]
+        hp_sigma[i] = nd_par[length][2 * j + 1]
 
-        mutated_hp_with_mis = ""
-        mis_pos = []
+    ref_sizes = np.array([hp_end - hp_start for base, hp_start, hp_end in hp_arr])
+    sizes = np.rint(np.maximum(np.random.normal(hp_mu, hp_sigma), 0)).astype(int)
+    hp_offsets = np.concatenate(([0], np.cumsum(sizes))).tolist()
 
-        for i in xrange(size):
-            p = random.random()
-            if 0 < p <= mis_rate:
-                tmp_bases = list(BASES)
-                while True:
-                    new_base = random.choice(tmp_bases)
-                    if new_base != base:
-                        break
-                mutated_hp_with_mis += new_base
-                mis_pos.append(i)
+    # Mismatches in the mutated homopolymers
+    mis_rate = nd.get_hpmis_rate(read_type, basecaller)
+    hp_bases = np.repeat(np.frombuffer("".join([hp[0] for hp in hp_arr]).encode(), dtype=np.uint8), sizes)
+    p = np.random.random(len(hp_bases))
+    is_mis = (0 < p) & (p <= mis_rate)
+    mis_shift = np.random.randint(1, 4, size=np.count_nonzero(is_mis))
+    hp_bases[is_mis] = BASES_ARRAY[(BASES_IDX[hp_bases[is_mis]] + mis_shift) % 4]
+    mutated_hps = hp_bases.tobytes().decode()
+
+    if len(base_quals) != 0:  # fastq
+        # Deletions drop the first quals of the homopolymer, insertions add quals after it and mismatches replace them
+        diffs = (sizes - ref_sizes).tolist()
+        n_ins = sum([diff for diff in diffs if diff > 0])
+        ins_quals = mm.trunc_lognorm_rvs("ins", read_type, basecaller, n_ins).tolist()
+        hp_quals = []
+        i_ins = 0
+        for (base, ref_hp_start, ref_hp_end), diff in zip(hp_arr, diffs):
+            if diff < 0:
+                hp_quals += base_quals[ref_hp_start - diff: ref_hp_end]
             else:
-                mutated_hp_with_mis += base
-            i += 1
-        mutated_seq = mutated_seq + seq[last_pos: ref_hp_start] + mutated_hp_with_mis
-
-        if len(base_quals) != 0:  # fastq
-            diff = size - (ref_hp_end - ref_hp_start)
-            if diff < 0:  # del, remove quals
-                for i in xrange(abs(diff)):
-                    base_quals.pop(ref_hp_start + total_hp_size_change)
-
-            elif diff > 0:  # ins, add quals
-                ins_quals = mm.trunc_lognorm_rvs("ins", read_type, basecaller, diff).tolist()
-                base_quals = base_quals[:ref_hp_end + total_hp_size_change] + ins_quals + \
-                             base_quals[ref_hp_end + total_hp_size_change:]
-
-            if len(mis_pos) != 0:  # mis, change match quals to mis quals
-                mis_quals = mm.trunc_lognorm_rvs("mis", read_type, basecaller, len(mis_pos)).tolist()
-                for i in zip(mis_pos, mis_quals):
-                    base_quals[ref_hp_start + total_hp_size_change + i[0]] = i[1]
-
-        total_hp_size_change += size - (ref_hp_end - ref_hp_start)
+                hp_quals += base_quals[ref_hp_start: ref_hp_end] + ins_quals[i_ins: i_ins + diff]
+                i_ins += diff
+        hp_quals = np.array(hp_quals, dtype=np.int64)
+        hp_quals[is_mis] = mm.trunc_lognorm_rvs("mis", read_type, basecaller, np.count_nonzero(is_mis))
+        hp_quals = hp_quals.tolist()
+
+    # Mutating homopolymers in given sequence
+    segments = []
+    quals = []
+    last_pos = 0
+    for i, (base, ref_hp_start, ref_hp_end) in enumerate(hp_arr):
+        segments.append(seq[last_pos: ref_hp_start])
+        segments.append(mutated_hps[hp_offsets[i]: hp_offsets[i + 1]])
+        if len(base_quals) != 0:
+            quals += base_quals[last_pos: ref_hp_start]
+            quals += hp_quals[hp_offsets[i]: hp_offsets[i + 1]]
         last_pos = ref_hp_end
 
-    return mutated_seq + seq[last_pos:], base_quals
+    segments.append(seq[last_pos:])
+    if len(base_quals) != 0:
+        quals += base_quals[last_pos:]
+
+    return "".join(segments), quals
 
 
 # Taken from https://github.com/lh3/readfq
@@ -708,21 +819,33 @@ def readfq(fp):  # this is a generator function
                 break
 
 
-def case_convert(seq):
-    base_code = {'Y': ['C', 'T'], 'R': ['A', 'G'], 'W': ['A', 'T'], 'S': ['G', 'C'], 'K': ['T', 'G'], 'M': ['C', 'A'],
-                 'D': ['A', 'G', 'T'], 'V': ['A', 'C', 'G'], 'H': ['A', 'C', 'T'], 'B': ['C', 'G', 'T'],
-                 'N': ['A', 'T', 'C', 'G'], 'X': ['A', 'T', 'C', 'G']}
+IUPAC_CODE = {'Y': ['C', 'T'], 'R': ['A', 'G'], 'W': ['A', 'T'], 'S': ['G', 'C'], 'K': ['T', 'G'], 'M': ['C', 'A'],
+              'D': ['A', 'G', 'T'], 'V': ['A', 'C', 'G'], 'H': ['A', 'C', 'T'], 'B': ['C', 'G', 'T'],
+              'N': ['A', 'T', 'C', 'G'], 'X': ['A', 'T', 'C', 'G']}
+IUPAC_RE = re.compile("[" + "".join(IUPAC_CODE.keys()) + "]")
 
+
+def case_convert(seq):
+    # Ambiguous bases are resolved with one draw for each IUPAC code in the sequence (Modified for SQANTI-SIM)
     up_string = seq.upper()
-    up_list = list(up_string)
-    for i in xrange(len(up_list)):
-        if up_list[i] in base_code:
-            up_list[i] = random.choice(base_code[up_list[i]])
-    out_seq = ''.join(up_list)
+    if not IUPAC_RE.search(up_string):
+        return up_string
+
+    up_arr = np.frombuffer(up_string.encode(), dtype=np.uint8).copy()
+    for code in sorted(set(IUPAC_RE.findall(up_string))):
+        bases = np.frombuffer("".join(IUPAC_CODE[code]).encode(), dtype=np.uint8)
+        is_code = up_arr == ord(code)
+        up_arr[is_code] = bases[np.random.randint(0, len(bases), size=np.count_nonzero(is_code))]
+    out_seq = up_arr.tobytes().decode()
 
     return out_seq
 
 
+def encode_quals(base_quals):
+    # Phred+33 string of a list of base qualities (Modified for SQANTI-SIM)
+    return (np.asarray(base_quals, dtype=np.uint8) + 33).tobytes().decode()
+
+
 def assign_species(length_list, seg_list, current_species_base_dict):
     # Deal with chimeric reads first
     seg_list_sorted = sorted(seg_list, reverse=True)
@@ -780,7 +903,7 @@ def assign_species(length_list, seg_list, current_species_base_dict):
 
 
 def simulation_aligned_metagenome(min_l, max_l, median_l, sd_l, out_reads, out_error, kmer_bias, basecaller,
-                                  read_type, fastq, num_simulate, per=False, chimeric=False):
+                                  read_type, fastq, num_simulate, per=False, chimeric=False, first_index=0):
     # Simulate aligned reads
     out_reads = open(out_reads, "w")
     out_error = open(out_error, "w")
@@ -840,9 +963,7 @@ def simulation_aligned_metagenome(min_l, max_l, median_l, sd_l, out_reads, out_e
                 seg_pointer += 1
                 gap_pointer += 1
                 species_pointer += 1
-                with total_simulated.get_lock():
-                    sequence_index = total_simulated.value
-                    total_simulated.value += 1
+                sequence_index = first_index + passed  # Disjoint index range of the worker (Modified for SQANTI-SIM)
 
                 # Extract middle region from reference genome
                 new_read = ""
@@ -886,7 +1007,7 @@ def simulation_aligned_metagenome(min_l, max_l, median_l, sd_l, out_reads, out_e
                     total += len(mutated_gap)
                 for each_ref in ref_length_list:
                     middle, middle_ref, error_dict, error_count = \
-                        error_list(each_ref, match_markov_model, match_ht_list, error_par, trans_error_pr, fastq)
+                        error_list(each_ref, error_model, fastq)
                     total += middle
                     seg_length_list.append(middle_ref)
                     seg_error_dict_list.append(error_dict)
@@ -899,9 +1020,7 @@ def simulation_aligned_metagenome(min_l, max_l, median_l, sd_l, out_reads, out_e
                 gap_pointer += segments - 1
                 species_pointer += segments
 
-                with total_simulated.get_lock():
-                    sequence_index = total_simulated.value
-                    total_simulated.value += 1
+                sequence_index = first_index + passed  # Disjoint index range of the worker (Modified for SQANTI-SIM)
 
                 if remainder == 0:
                     head = 0
@@ -960,8 +1079,7 @@ def simulation_aligned_metagenome(min_l, max_l, median_l, sd_l, out_reads, out_e
                     base_quals = ht_quals[:head] + base_quals + ht_quals[head:]
 
             # Add head and tail region
-            read_mutated = ''.join(np.random.choice(BASES, head)) + read_mutated + \
-                           ''.join(np.random.choice(BASES, tail))
+            read_mutated = random_bases(head) + read_mutated + random_bases(tail)
 
             # Reverse complement half of the reads
             if is_reversed:
@@ -973,10 +1091,10 @@ def simulation_aligned_metagenome(min_l, max_l, median_l, sd_l, out_reads, out_e
 
             if fastq:
                 out_reads.write("+\n")
-                out_quals = "".join([chr(qual + 33) for qual in base_quals])
+                out_quals = encode_quals(base_quals)
                 out_reads.write(out_quals + "\n")
 
-            check_print_progress(sequence_index)
+            check_print_progress(passed + 1)
 
             passed += 1
 
@@ -989,8 +1107,52 @@ def simulation_aligned_metagenome(min_l, max_l, median_l, sd_l, out_reads, out_e
     out_error.close()
 
 
+def balance_units(trx_counts, dict_ref_len, n_parts):
+    # Splits the reads to simulate in n_parts lists of units (transcript, first read, number of reads, first read
+    # index) with about the same expected bases. Transcripts are only cut at KDE pool blocks and read indexes are
+    # numbered by transcript, so they do not depend on n_parts (Modified for SQANTI-SIM)
+    total_bases = sum([n_reads * dict_ref_len[ref_trx] for ref_trx, n_reads in trx_counts])
+    part_bases = total_bases / n_parts
+    parts = [[] for i in range(n_parts)]
+    part = 0
+    bases = 0
+    index0 = 0
+    for ref_trx, n_reads in trx_counts:
+        trx_len = max(dict_ref_len[ref_trx], 1)
+        j0 = 0
+        while j0 < n_reads:
+            if part == n_parts - 1:
+                count = n_reads - j0
+            else:
+                count = int(math.ceil(((part + 1) * part_bases - bases) / trx_len / KDE_POOL_READS)) * KDE_POOL_READS
+                count = min(max(count, KDE_POOL_READS), n_reads - j0)
+            parts[part].append((ref_trx, j0, count, index0 + j0))
+            j0 += count
+            bases += count * trx_len
+            if part < n_parts - 1 and bases >= (part + 1) * part_bases:
+                part += 1
+        index0 += n_reads
+    return parts
+
+
+def shuffled_reads(units):
+    # Yields (transcript, read, read index) of the units in a random order of blocks of KDE_POOL_READS reads. Only the
+    # block numbers are permuted, reads are generated as they are simulated (Modified for SQANTI-SIM)
+    if not units:
+        return
+    unit_blocks = np.cumsum([int(math.ceil(count / KDE_POOL_READS)) for ref_trx, j0, count, index0 in units])
+    for block in np.random.permutation(int(unit_blocks[-1])).tolist():
+        u = int(np.searchsorted(unit_blocks, block, side="right"))
+        ref_trx, j0, count, index0 = units[u]
+        start = (block - (int(unit_blocks[u - 1]) if u > 0 else 0)) * KDE_POOL_READS
+        for j in range(start, min(start + KDE_POOL_READS, count)):
+            yield ref_trx, j0 + j, index0 + j
+
+
 def simulation_aligned_transcriptome(model_ir, out_reads, out_error, kmer_bias, basecaller, read_type, num_simulate,
-                                     polya, fastq, per=False, uracil=False, reads_to_sim_thread=None, dict_ref_len=None):
+                                     polya, fastq, per=False, uracil=False, units_thread=None, dict_ref_len=None,
+                                     seed=None, read_prefix=None, out_isoforms=None, counts_queue=None,
+                                     out_truth=None, dtype_truth=None):
 
     if basecaller == "albacore":
         polya_len_dist_scale = 2.409858743694814
@@ -1003,7 +1165,14 @@ def simulation_aligned_transcriptome(model_ir, out_reads, out_error, kmer_bias,
                                          
     # Simulate aligned reads
     out_reads = open(out_reads, "w")
-    out_error = open(out_error, "w")
+    if out_error:  # The error profile is optional (Modified for SQANTI-SIM)
+        out_error = open(out_error, "w")
+    if read_prefix:  # SQANTI-SIM read names, read-to-isoform rows and counts (Modified for SQANTI-SIM)
+        out_isoforms = open(out_isoforms, "w")
+        trx_counts = {}
+    if out_truth:  # Ground truth records written in batches (Modified for SQANTI-SIM)
+        out_truth = open(out_truth, "wb")
+        truth_rows = []
 
     if fastq:
         id_begin = "@"
@@ -1018,57 +1187,40 @@ def simulation_aligned_transcriptome(model_ir, out_reads, out_error, kmer_bias,
                 flag_chrom = True
                 break
 
-    remainder_l = get_length_kde(kde_ht, num_simulate, True)
-    head_vs_ht_ratio_temp = get_length_kde(kde_ht_ratio, num_simulate)
-    head_vs_ht_ratio_l = [1 if x > 1 else x for x in head_vs_ht_ratio_temp]
-    head_vs_ht_ratio_l = [0 if x < 0 else x for x in head_vs_ht_ratio_l]
-
     simulated = 0
-    sampled_2d_lengths = get_length_kde(kde_aligned_2d, num_simulate, False, False) # initial sample from the KDE
-    trx_sampled = set() # track transcript IDs that are associated with the KDE sample
+    ir_missing = 0
 
     #while simulated < num_simulate:
-    for ref_trx in reads_to_sim_thread:
+    for ref_trx, trx_read, sequence_index in shuffled_reads(units_thread):
         ref_trx_len = dict_ref_len[ref_trx]
         while True:            
             # select a random reference transcript
             #ref_trx, ref_trx_len = random.choices(ecdf_length_list, weights=ecdf_weight_list, k=1)[0]
             
-            # if this transcript was previously associated with the currect KDE sample
-            if ref_trx in trx_sampled:
-                # draw a new sample from the KDE
-                sampled_2d_lengths = get_length_kde(kde_aligned_2d, num_simulate, False, False)
-                
-                # track a new set of transcript IDs
-                trx_sampled = set()
-
+            # take the next sample of the KDE pool of this read (Modified for SQANTI-SIM)
             if model_ir:
                 if ref_trx in dict_ref_structure:
                     ref_trx_len_fromstructure = ref_len_from_structure(dict_ref_structure[ref_trx])
                     if ref_trx_len == ref_trx_len_fromstructure:
-                        ref_len_aligned = select_nearest_kde2d(sampled_2d_lengths, ref_trx_len)
-                        if ref_len_aligned < ref_trx_len:
-                            break
+                        ref_len_aligned = select_nearest_kde2d(seed, ref_trx, trx_read, ref_trx_len, ref_trx_len)
+                        break
             else:
-                ref_len_aligned = select_nearest_kde2d(sampled_2d_lengths, ref_trx_len)
+                ref_len_aligned = select_nearest_kde2d(seed, ref_trx, trx_read, ref_trx_len)
                 if ref_len_aligned < ref_trx_len:
                     break
                 else: # If selected length is bigger, simulate the whole transcript (Modified for SQANTI-SIM)
                     ref_len_aligned = ref_trx_len
                     break
 
-        
-        # associate the transcript ID to the KDE sample
-        trx_sampled.add(ref_trx)
+        # Random stream and read number only depend on the read, not on the process (Modified for SQANTI-SIM)
+        seed_stream(seed, ref_trx, trx_read)
                
         trx_has_polya = polya and ref_trx in trx_with_polya     
         is_reversed = random.random() > strandness_rate
+        n_errors = {"mis": 0, "ins": 0, "del": 0}
+        ir_list = []
             
         if per:
-            with total_simulated.get_lock():
-                sequence_index = total_simulated.value
-                total_simulated.value += 1
-
             new_read, ref_start_pos, retain_polya = extract_read_trx(ref_trx, ref_len_aligned, trx_has_polya)
             new_read_name = ref_trx + "_" + str(ref_start_pos) + "_perfect_" + str(sequence_index)
             read_mutated = case_convert(new_read)  # not mutated actually, just to be consistent with per == False
@@ -1094,43 +1246,39 @@ def simulation_aligned_transcriptome(model_ir, out_reads, out_error, kmer_bias,
                 polya_len = 0
                         
             new_read_name += "_0_" + str(ref_len_aligned) + "_" + str(polya_len)
+            if read_prefix:
+                new_read_name = ref_trx + read_prefix + str(sequence_index)  # Modified for SQANTI-SIM
             
         else:
-            middle_read, middle_ref, error_dict, error_count = error_list(ref_len_aligned, match_markov_model,
-                                                                          match_ht_list, error_par, trans_error_pr,
-                                                                          fastq)
+            middle_read, middle_ref, error_dict, error_count = error_list(ref_len_aligned, error_model, fastq)
 
             # if middle_ref > ref_trx_len:    
                 #continue
             while middle_ref > ref_trx_len: # Sample until you get valid middle_ref (Modified for SQANTI-SIM)
-                middle_read, middle_ref, error_dict, error_count = error_list(ref_len_aligned, match_markov_model,
-                                                                              match_ht_list, error_par, trans_error_pr,
-                                                                              fastq)
-
-            with total_simulated.get_lock():
-                sequence_index = total_simulated.value
-                total_simulated.value += 1
+                middle_read, middle_ref, error_dict, error_count = error_list(ref_len_aligned, error_model, fastq)
 
-            ir_list = []
             if model_ir:
                 ir_flag, ref_trx_structure_new = update_structure(dict_ref_structure[ref_trx], IR_markov_model)
                 if ir_flag:
                     list_iv, retain_polya, ir_list = extract_read_pos(middle_ref, ref_trx_len, ref_trx_structure_new,
                                                                       trx_has_polya)
-                    new_read = ""
-                    flag = False
+                    chroms = []
                     for interval in list_iv:
                         chrom = interval.chrom
                         if flag_chrom:
                             chrom = "chr" + chrom
-                        if chrom not in genome_fai.references:
-                            flag = True
-                            break
-                        start = interval.start
-                        end = interval.end
-                        new_read += genome_fai.fetch(chrom, start, end)  # len(new_read) > middle_ref
-                    if flag:
-                        continue
+                        chroms.append(chrom)
+                    if any(chrom not in genome_fai.references for chrom in chroms):
+                        # The intron can not be retained without its genome sequence, the read is simulated from
+                        # the transcript instead of being dropped (Modified for SQANTI-SIM)
+                        ir_flag = False
+                        ir_list = []
+                        ir_missing += 1
+
+                if ir_flag:
+                    new_read = ""
+                    for interval, chrom in zip(list_iv, chroms):
+                        new_read += genome_fai.fetch(chrom, interval.start, interval.end)  # len(new_read) > middle_ref
                     ref_start_pos = list_iv[0].start
  
                     if interval.strand == '-':  # Keep the read direction the same as reference transcripts
@@ -1156,8 +1304,8 @@ def simulation_aligned_transcriptome(model_ir, out_reads, out_error, kmer_bias,
                 new_read_name += "_F"
             
             # start HD len simulation
-            remainder = int(remainder_l[simulated])
-            head_vs_ht_ratio = head_vs_ht_ratio_l[simulated]
+            remainder = int(get_length_kde(kde_ht, 1, True)[0])
+            head_vs_ht_ratio = min(max(get_length_kde(kde_ht_ratio, 1)[0], 0), 1)
             
             if remainder == 0:
                 head = 0
@@ -1176,11 +1324,13 @@ def simulation_aligned_transcriptome(model_ir, out_reads, out_error, kmer_bias,
             new_read_name += "_" + str(head) + \
                              "_" + str(middle_ref) + \
                              "_" + str(tail + polya_len)
+            if read_prefix:
+                new_read_name = ref_trx + read_prefix + str(sequence_index)  # Modified for SQANTI-SIM
             
             # Mutate read
             new_read = case_convert(new_read)
             read_mutated, base_quals = mutate_read(new_read, new_read_name, out_error, error_dict, error_count,
-                                                   basecaller, read_type, fastq, kmer_bias)
+                                                   basecaller, read_type, fastq, kmer_bias, n_errors)
             if kmer_bias:
                 read_mutated, base_quals = mutate_homo(read_mutated, base_quals, kmer_bias, basecaller, read_type)
             
@@ -1194,7 +1344,7 @@ def simulation_aligned_transcriptome(model_ir, out_reads, out_error, kmer_bias,
             base_quals = ht_quals[:head] + base_quals + ht_quals[head:]
 
         # Add head and tail region
-        read_mutated = ''.join(np.random.choice(BASES, head)) + read_mutated + ''.join(np.random.choice(BASES, tail))
+        read_mutated = random_bases(head) + read_mutated + random_bases(tail)
         
         # Reverse complement according to strandness rate
         if is_reversed:
@@ -1210,20 +1360,41 @@ def simulation_aligned_transcriptome(model_ir, out_reads, out_error, kmer_bias,
 
         if fastq:
             out_reads.write("+\n")
-            out_quals = "".join([chr(qual + 33) for qual in base_quals])
+            out_quals = encode_quals(base_quals)
             out_reads.write(out_quals + "\n")
 
-        check_print_progress(sequence_index)
+        if read_prefix:
+            out_isoforms.write(new_read_name + "\t" + ref_trx + "\n")
+            trx_counts[ref_trx] = trx_counts.get(ref_trx, 0) + 1
+
+        if out_truth:
+            truth_rows.append((sequence_index, ref_trx, True, "-" if is_reversed else "+", ref_start_pos,
+                               ref_len_aligned if per else middle_ref, head, tail, polya_len, len(ir_list) > 0,
+                               n_errors["mis"], n_errors["ins"], n_errors["del"]))
+            if len(truth_rows) == TRUTH_BATCH:
+                write_truth(out_truth, truth_rows, dtype_truth)
+
+        check_print_progress(simulated + 1)
 
         simulated += 1
 
     sys.stdout.write('\n')
+    if ir_missing > 0:
+        sys.stdout.write(strftime("%Y-%m-%d %H:%M:%S") + ": Warning, " + str(ir_missing) +
+                         " reads simulated without retained introns, their chromosome is not in the genome\n")
     out_reads.close()
-    out_error.close()
+    if out_error:
+        out_error.close()
+    if read_prefix:
+        out_isoforms.close()
+        counts_queue.put(trx_counts)
+    if out_truth:
+        write_truth(out_truth, truth_rows, dtype_truth)
+        out_truth.close()
 
 
 def simulation_aligned_genome(dna_type, min_l, max_l, median_l, sd_l, out_reads, out_error, kmer_bias, basecaller,
-                              read_type, fastq, num_simulate, per=False, chimeric=False):
+                              read_type, fastq, num_simulate, per=False, chimeric=False, first_index=0):
 
     # Simulate aligned reads
     out_reads = open(out_reads, "w")
@@ -1276,9 +1447,7 @@ def simulation_aligned_genome(dna_type, min_l, max_l, median_l, sd_l, out_reads,
             if per:
                 seg_pointer += 1
                 gap_pointer += 1
-                with total_simulated.get_lock():
-                    sequence_index = total_simulated.value
-                    total_simulated.value += 1
+                sequence_index = first_index + passed  # Disjoint index range of the worker (Modified for SQANTI-SIM)
 
                 # Extract middle region from reference genome
                 new_read = ""
@@ -1320,7 +1489,7 @@ def simulation_aligned_genome(dna_type, min_l, max_l, median_l, sd_l, out_reads,
                     gap_base_qual_list.append(gap_base_quals)
                 for each_ref in ref_length_list:
                     middle, middle_ref, error_dict, error_count = \
-                        error_list(each_ref, match_markov_model, match_ht_list, error_par, trans_error_pr, fastq)
+                        error_list(each_ref, error_model, fastq)
                     total += middle
                     seg_length_list.append(middle_ref)
                     seg_error_dict_list.append(error_dict)
@@ -1332,9 +1501,7 @@ def simulation_aligned_genome(dna_type, min_l, max_l, median_l, sd_l, out_reads,
                 seg_pointer += segments
                 gap_pointer += segments - 1
 
-                with total_simulated.get_lock():
-                    sequence_index = total_simulated.value
-                    total_simulated.value += 1
+                sequence_index = first_index + passed  # Disjoint index range of the worker (Modified for SQANTI-SIM)
 
                 if remainder == 0:
                     head = 0
@@ -1386,8 +1553,7 @@ def simulation_aligned_genome(dna_type, min_l, max_l, median_l, sd_l, out_reads,
                     base_quals = ht_quals[:head] + base_quals + ht_quals[head:]
 
             # Add head and tail region
-            read_mutated = ''.join(np.random.choice(BASES, head)) + read_mutated + \
-                           ''.join(np.random.choice(BASES, tail))
+            read_mutated = random_bases(head) + read_mutated + random_bases(tail)
 
             # Reverse complement half of the reads
             if is_reversed:
@@ -1399,10 +1565,10 @@ def simulation_aligned_genome(dna_type, min_l, max_l, median_l, sd_l, out_reads,
 
             if fastq:
                 out_reads.write("+\n")
-                out_quals = "".join([chr(qual + 33) for qual in base_quals])
+                out_quals = encode_quals(base_quals)
                 out_reads.write(out_quals + "\n")
 
-            check_print_progress(sequence_index)
+            check_print_progress(passed + 1)
 
             passed += 1
 
@@ -1415,8 +1581,15 @@ def simulation_aligned_genome(dna_type, min_l, max_l, median_l, sd_l, out_reads,
 
 
 def simulation_unaligned(dna_type, min_l, max_l, median_l, sd_l, out_reads, basecaller, read_type, fastq,
-                         num_simulate, uracil):
+                         num_simulate, uracil, first_index=0, read_prefix=None, out_isoforms=None, counts_queue=None,
+                         out_truth=None, dtype_truth=None):
     out_reads = open(out_reads, "w")
+    if read_prefix:  # SQANTI-SIM read names, read-to-isoform rows and counts (Modified for SQANTI-SIM)
+        out_isoforms = open(out_isoforms, "w")
+        trx_counts = {}
+    if out_truth:  # Ground truth records written in batches (Modified for SQANTI-SIM)
+        out_truth = open(out_truth, "wb")
+        truth_rows = []
 
     if fastq:
         id_begin = "@"
@@ -1439,17 +1612,17 @@ def simulation_unaligned(dna_type, min_l, max_l, median_l, sd_l, out_reads, base
             if unaligned < min_l or unaligned > max_l:
                 continue
 
-            with total_simulated.get_lock():
-                sequence_index = total_simulated.value
-                total_simulated.value += 1
+            sequence_index = first_index + passed  # Disjoint index range of the worker (Modified for SQANTI-SIM)
 
             new_read, new_read_name = extract_read(dna_type, middle_ref)
+            ref_trx, ref_pos = new_read_name.rsplit("_", 1)  # Source of the fragment (Modified for SQANTI-SIM)
             new_read_name = new_read_name + "_unaligned_" + str(sequence_index)
             # Change lowercase to uppercase and replace N with any base
             new_read = case_convert(new_read)
             # no quals returned here since unaligned quals are not based on mis/ins/match qual distributions
+            n_errors = {"mis": 0, "ins": 0, "del": 0}
             read_mutated, _ = mutate_read(new_read, new_read_name, None, error_dict, error_count, basecaller,
-                                          read_type, False, False)
+                                          read_type, False, False, n_errors)
 
             if fastq:
                 base_quals = mm.trunc_lognorm_rvs("unaligned", read_type, basecaller, len(read_mutated)).tolist()
@@ -1458,29 +1631,49 @@ def simulation_unaligned(dna_type, min_l, max_l, median_l, sd_l, out_reads, base
 
             # Reverse complement some of the reads based on direction information
             p = random.random()
-            if p > strandness_rate:
+            is_reversed = p > strandness_rate
+            if is_reversed:
                 read_mutated = reverse_complement(read_mutated)
                 new_read_name += "_R"
                 base_quals.reverse()
             else:
                 new_read_name += "_F"
 
-            out_reads.write(id_begin + new_read_name + "_0_" + str(middle_ref) + "_0" + '\n')
+            new_read_name += "_0_" + str(middle_ref) + "_0"
+            if read_prefix:
+                new_read_name = ref_trx + read_prefix + str(sequence_index)  # Modified for SQANTI-SIM
+            out_reads.write(id_begin + new_read_name + '\n')
             if uracil:
                 read_mutated = read_mutated.translate(trantab) # Fix for SQANTI-SIM
             out_reads.write(read_mutated + "\n")
 
             if fastq:
                 out_reads.write("+\n")
-                out_quals = "".join([chr(qual + 33) for qual in base_quals])
+                out_quals = encode_quals(base_quals)
                 out_reads.write(out_quals + "\n")
 
-            check_print_progress(sequence_index)
+            if read_prefix:
+                out_isoforms.write(new_read_name + "\t" + ref_trx + "\n")
+                trx_counts[ref_trx] = trx_counts.get(ref_trx, 0) + 1
+
+            if out_truth:
+                truth_rows.append((sequence_index, ref_trx, False, "-" if is_reversed else "+", int(ref_pos),
+                                   middle_ref, 0, 0, 0, False, n_errors["mis"], n_errors["ins"], n_errors["del"]))
+                if len(truth_rows) == TRUTH_BATCH:
+                    write_truth(out_truth, truth_rows, dtype_truth)
+
+            check_print_progress(passed + 1)
             
             passed += 1
 
         remaining_reads = num_simulate - passed
     out_reads.close()
+    if read_prefix:
+        out_isoforms.close()
+        counts_queue.put(trx_counts)
+    if out_truth:
+        write_truth(out_truth, truth_rows, dtype_truth)
+        out_truth.close()
 
 
 def simulation_gap(ref, basecaller, read_type, dna_type, fastq):
@@ -1503,10 +1696,86 @@ def simulation_gap(ref, basecaller, read_type, dna_type, fastq):
     return gap_mutated, base_quals
 
 
+# Merging of the worker subfiles (Modified for SQANTI-SIM)
+def append_file(fname, f_out):
+    # Appends a file to a binary output file, copied by the kernel where copy_file_range is supported
+    size = os.path.getsize(fname)
+    with open(fname, 'rb') as f_in:
+        f_out.flush()
+        start = f_out.tell()
+        offset = 0
+        try:
+            while offset < size:
+                copied = os.copy_file_range(f_in.fileno(), f_out.fileno(), size - offset, offset, start + offset)
+                if copied == 0:
+                    break
+                offset += copied
+        except (AttributeError, OSError):
+            pass
+        f_in.seek(offset)
+        f_out.seek(start + offset)
+        shutil.copyfileobj(f_in, f_out, MERGE_CHUNK)
+
+
+def get_truth_dtype(id_len):
+    # One record per read: source transcript and strand, reference start and aligned length, head, tail and polyA
+    # lengths and bases of each error type (homopolymer length changes of --KmerBias are not included)
+    return np.dtype([("read_index", "<i8"), ("transcript", "S" + str(id_len)), ("aligned", "?"), ("strand", "S1"),
+                     ("start", "<i8"), ("length", "<i4"), ("head", "<i4"), ("tail", "<i4"), ("polya", "<i4"),
+                     ("retained_intron", "?"), ("mis", "<i4"), ("ins", "<i4"), ("del", "<i4")])
+
+
+def write_truth(out_truth, truth_rows, dtype_truth):
+    # Raw records of a batch, the .npy header is added when the subfiles are merged
+    if truth_rows:
+        out_truth.write(np.array(truth_rows, dtype=dtype_truth).tobytes())
+        del truth_rows[:]
+
+
+def merge_truth(subfiles, out_name, dtype_truth):
+    # Single structured array that loads with np.load or pandas.DataFrame(np.load(...))
+    n_reads = sum([os.path.getsize(fname) for fname in subfiles]) // dtype_truth.itemsize
+    header = io.BytesIO()
+    np.lib.format.write_array_header_1_0(header, {"descr": np.lib.format.dtype_to_descr(dtype_truth),
+                                                  "fortran_order": False, "shape": (n_reads,)})
+    merge_subfiles(subfiles, out_name, header.getvalue())
+
+
+def collect_counts(counts_queue, n_workers, sim_counts):
+    # Adds the read counts of each transcript sent by the workers
+    for i in range(n_workers):
+        for ref_trx, count in counts_queue.get().items():
+            sim_counts[ref_trx] = sim_counts.get(ref_trx, 0) + count
+
+
+def merge_subfiles(subfiles, out_name, header=""):
+    # Without a header the first subfile becomes the output file, so a single worker never copies its reads
+    if header:
+        if not isinstance(header, bytes):
+            header = header.encode()
+        with open(out_name, 'wb') as f_out:
+            f_out.write(header)
+        rest = subfiles
+    else:
+        os.replace(subfiles[0], out_name)
+        rest = subfiles[1:]
+
+    with open(out_name, 'r+b') as f_out:
+        f_out.seek(0, os.SEEK_END)
+        for fname in rest:
+            append_file(fname, f_out)
+            os.remove(fname)
+
+
 def simulation(mode, out, dna_type, per, kmer_bias, basecaller, read_type, max_l, min_l, num_threads, fastq,
-               median_l=None, sd_l=None, model_ir=False, uracil=False, polya=None, chimeric=False, exp=None):
-    # exp argument added by Jorge Mestre (SQANTI-SIM)
-    global total_simulated  # Keeps track of number of reads that have been simulated so far
+               median_l=None, sd_l=None, model_ir=False, uracil=False, polya=None, chimeric=False, exp=None, seed=None,
+               read_to_isoform=False, truth_store=False, error_profile=True):
+    # exp, seed, read_to_isoform, truth_store and error_profile arguments added by Jorge Mestre (SQANTI-SIM)
+    if not seed:
+        seed = np.random.SeedSequence().entropy
+    seed = int(seed)
+
+    global total_simulated  # Keeps track of number of reads that have been simulated so far, for progress only
     total_simulated = mp.Value("i", 0, lock=True)
 
     # Start simulation
@@ -1520,87 +1789,100 @@ def simulation(mode, out, dna_type, per, kmer_bias, basecaller, read_type, max_l
     procs = []
     aligned_subfiles = []
     error_subfiles = []
+
+    # Reads are named <transcript>_<output name>_read_<index> as they are written (Modified for SQANTI-SIM)
+    isoform_subfiles = []
+    sim_counts = {}
+    if read_to_isoform:
+        read_prefix = "_" + os.path.basename(out) + "_read_"
+        counts_queue = mp.Queue()
+    else:
+        read_prefix = None
+        counts_queue = None
+
+    # Ground truth of each read in <out>_truth.npy (Modified for SQANTI-SIM)
+    truth_subfiles = []
+    if truth_store:
+        dtype_truth = get_truth_dtype(max([len(ref_trx) for ref_trx in seq_len]))
+    else:
+        dtype_truth = None
     #num_simulate = int(number_aligned / num_threads)
     
-    # Get expression dictionary(Modified for SQANTI-SIM)
-    dict_exp = {}
-    with open(exp, 'r') as exp_file:
-        header = exp_file.readline()
-        for line in exp_file:
-            parts = line.split("\t")
-            if len(parts) < 3:
-                sys.stderr.write("Expression profile must contain 3 columns: ID, count, TPM \n")
-                sys.exit(1)
-            #transcript_id = parts[0].split(".")[0]
-            transcript_id = parts[0]
-            tpm = float(parts[2])
-            if tpm > 0:
-                dict_exp[transcript_id] = tpm
-    exp_file.close()
-
-    # Simulate x reads for each trans (Modified for SQANTI-SIM)
+    # Simulate x reads for each trans, as (transcript, number of reads) (Modified for SQANTI-SIM)
     dict_ref_len = {}
-    reads_to_sim = []
+    trx_counts = []
     for ref_trx, ref_trx_len in ecdf_length_list:
         dict_ref_len[ref_trx] = ref_trx_len
         trans_n_reads = int(round((dict_exp[ref_trx]*number_aligned)/1000000))
-        reads_to_sim.extend([ref_trx]*trans_n_reads)
-    random.shuffle(reads_to_sim)
-
-    num_simulate = int(math.ceil(len(reads_to_sim) / num_threads) + 1) # Modified for SQANTI-SIM
+        if trans_n_reads > 0:
+            trx_counts.append((ref_trx, trans_n_reads))
+    units = balance_units(trx_counts, dict_ref_len, num_threads)
+    if mode == "transcriptome":
+        total_aligned = sum([n_reads for ref_trx, n_reads in trx_counts])
+    else:
+        total_aligned = number_aligned
 
     for i in range(num_threads):
-        np.random.seed()
-        random.seed()
+        seed_stream(seed, out, "aligned", i)  # Seed the genome/metagenome workers (Modified for SQANTI-SIM)
         aligned_subfile = out + "_aligned_reads{}".format(i) + ext
         error_subfile = out + "_error_profile{}".format(i)
         aligned_subfiles.append(aligned_subfile)
-        error_subfiles.append(error_subfile)
-        #if i == num_threads - 1:  # Last process will simulate the remaining reads
-        #    num_simulate += number_aligned % num_threads
+        if error_profile:
+            error_subfiles.append(error_subfile)
+        else:
+            error_subfile = None
+        # Each worker numbers its reads from its own first index (Modified for SQANTI-SIM)
+        num_simulate = int(number_aligned / num_threads)
+        first_index = num_simulate * i
+        if i == num_threads - 1:  # Last process will simulate the remaining reads
+            num_simulate += number_aligned % num_threads
 
         if mode == "genome":
             p = mp.Process(target=simulation_aligned_genome,
                            args=(dna_type, min_l, max_l, median_l, sd_l, aligned_subfile, error_subfile,
-                                 kmer_bias, basecaller, read_type, fastq, num_simulate, per, chimeric))
+                                 kmer_bias, basecaller, read_type, fastq, num_simulate, per, chimeric,
+                                 first_index))
             procs.append(p)
             p.start()
 
         elif mode == "metagenome":
             p = mp.Process(target=simulation_aligned_metagenome,
                            args=(min_l, max_l, median_l, sd_l, aligned_subfile, error_subfile, kmer_bias,
-                                 basecaller, read_type, fastq, num_simulate, per, chimeric))
+                                 basecaller, read_type, fastq, num_simulate, per, chimeric, first_index))
             procs.append(p)
             p.start()
 
         else:
-            reads_to_sim_thread = reads_to_sim[(num_simulate*i):(num_simulate*(i+1))]
+            num_simulate = sum([count for ref_trx, j0, count, index0 in units[i]])
+            isoform_subfile = out + "_read_to_isoform{}".format(i)
+            if read_prefix:
+                isoform_subfiles.append(isoform_subfile)
+            truth_subfile = out + "_truth{}".format(i)
+            if truth_store:
+                truth_subfiles.append(truth_subfile)
+            else:
+                truth_subfile = None
             p = mp.Process(target=simulation_aligned_transcriptome,
                            args=(model_ir, aligned_subfile, error_subfile, kmer_bias, basecaller, read_type,
                                  num_simulate, polya, fastq, per, uracil,
-                                 reads_to_sim_thread, dict_ref_len)) # Add exp file and num_threads (Modified for SQANTI-SIM)
+                                 units[i], dict_ref_len, seed, read_prefix, isoform_subfile,
+                                 counts_queue, truth_subfile,
+                                 dtype_truth)) # Add exp file and num_threads (Modified for SQANTI-SIM)
             procs.append(p)
             p.start()
 
+    if read_prefix:  # Collected before joining so that the workers can flush the queue (Modified for SQANTI-SIM)
+        collect_counts(counts_queue, len(procs), sim_counts)
     for p in procs:
         p.join()
 
     sys.stdout.write('\n')  # Start a new line because the "Number of reads simulated" is not returned
     # Merging aligned reads subfiles and error subfiles
-    with open(out + "_aligned_reads" + ext, 'w') as out_aligned_reads:
-        for fname in aligned_subfiles:
-            with open(fname) as infile:
-                out_aligned_reads.write(infile.read())
-    for fname in aligned_subfiles:
-        os.remove(fname)
-
-    with open(out + "_aligned_error_profile", 'w') as out_error:
-        out_error.write("Seq_name\tSeq_pos\terror_type\terror_length\tref_base\tseq_base\n")
-        for fname in error_subfiles:
-            with open(fname) as infile:
-                out_error.write(infile.read())
-    for fname in error_subfiles:
-        os.remove(fname)
+    # Streamed without loading the subfiles in memory (Modified for SQANTI-SIM)
+    merge_subfiles(aligned_subfiles, out + "_aligned_reads" + ext)
+    if error_profile:
+        merge_subfiles(error_subfiles, out + "_aligned_error_profile",
+                       "Seq_name\tSeq_pos\terror_type\terror_length\tref_base\tseq_base\n")
 
     # Simulate unaligned reads, if per, number_unaligned = 0, taken care of in read_ecdf
     if not per:
@@ -1609,47 +1891,64 @@ def simulation(mode, out, dna_type, per, kmer_bias, basecaller, read_type, max_l
         unaligned_subfiles = []
         # unaligned_error_subfiles = []
         num_simulate = int(number_unaligned / num_threads)
+        first_index = total_aligned  # Unaligned reads are numbered after the aligned ones (Modified for SQANTI-SIM)
+        procs = []
         for i in range(num_threads):
             unaligned_subfile = out + "_unaligned_reads{}".format(i) + ext
             # unaligned_error_subfile = out + "_unaligned_error_profile{}".format(i) + ext
             unaligned_subfiles.append(unaligned_subfile)
+            isoform_subfile = out + "_unaligned_read_to_isoform{}".format(i)
+            if read_prefix:
+                isoform_subfiles.append(isoform_subfile)
+            truth_subfile = out + "_unaligned_truth{}".format(i)
+            if truth_store:
+                truth_subfiles.append(truth_subfile)
+            else:
+                truth_subfile = None
             # unaligned_error_subfiles.append(unaligned_error_subfile)
             if i == num_threads - 1:
                 num_simulate += number_unaligned % num_threads
+            seed_stream(seed, out, "unaligned", i)  # Modified for SQANTI-SIM
 
             # Dividing number of unaligned reads that need to be simulated amongst the number of processes
             p = mp.Process(target=simulation_unaligned,
                            args=(dna_type, min_l, max_l, median_l, sd_l, unaligned_subfile,
-                                 basecaller, read_type, fastq, num_simulate, uracil))
+                                 basecaller, read_type, fastq, num_simulate, uracil, first_index, read_prefix,
+                                 isoform_subfile, counts_queue, truth_subfile, dtype_truth))
             procs.append(p)
             p.start()
+            first_index += num_simulate
 
+        if read_prefix:
+            collect_counts(counts_queue, len(procs), sim_counts)
         for p in procs:
             p.join()
 
         sys.stdout.write('\n')  # Start a new line because the "Number of reads simulated" is not returned
         # Merging unaligned reads subfiles and error subfiles
-        with open(out + "_unaligned_reads" + ext, 'w') as out_unaligned_reads:
-            for fname in unaligned_subfiles:
-                with open(fname) as infile:
-                    out_unaligned_reads.write(infile.read())
-        for fname in unaligned_subfiles:
-            os.remove(fname)
+        merge_subfiles(unaligned_subfiles, out + "_unaligned_reads" + ext)  # Modified for SQANTI-SIM
+
+    # Read-to-isoform table in the order of the reads and simulated counts of each transcript (Modified for SQANTI-SIM)
+    if read_prefix:
+        merge_subfiles(isoform_subfiles, out + "_read_to_isoform.tsv")
+        with open(out + "_counts.tsv", 'w') as out_counts:
+            out_counts.write("transcript_id\tsim_counts\n")
+            for ref_trx in sorted(sim_counts):
+                out_counts.write(ref_trx + "\t" + str(sim_counts[ref_trx]) + "\n")
+
+    if truth_store:
+        merge_truth(truth_subfiles, out + "_truth.npy", dtype_truth)
 
 
 def reverse_complement(seq):
-    comp = {'A': 'T', 'T': 'A', 'C': 'G', 'G': 'C'}
-    seq_list = list(seq)
-    reverse_seq_list = reversed([comp.get(base, base) for base in seq_list])
-    reverse_seq = ''.join(reverse_seq_list)
-    return reverse_seq
+    return seq.translate(comptab)[::-1]
 
 
 def extract_read_trx(key, length, trx_has_polya, buffer=10):
     # buffer: if the extracted read is within 10 base to the reference 3' end, it's considered as reaching to the end
     # TODO change the random into something truer
     ref_pos = random.randint(0, seq_len[key] - length)
-    new_read = seq_dict[key][ref_pos: ref_pos + length]
+    new_read = seq_dict.fetch(key, ref_pos, ref_pos + length)  # Modified for SQANTI-SIM
     retain_polya = False
     if trx_has_polya and ref_pos + length + buffer >= seq_len[key]:  # Read reaches end of transcript
         retain_polya = True
@@ -1662,7 +1961,7 @@ def extract_read(dna_type, length, s=None):
             key = random.choice(list(seq_len.keys()))  # added "list" thing to be compatible with Python v3
             if length < seq_len[key]:
                 ref_pos = random.randint(0, seq_len[key] - length)
-                new_read = seq_dict[key][ref_pos: ref_pos + length]
+                new_read = seq_dict.fetch(key, ref_pos, ref_pos + length)  # Modified for SQANTI-SIM
                 new_read_name = key + "_" + str(ref_pos)
                 break
         return new_read, new_read_name
@@ -1768,7 +2067,56 @@ def unaligned_error_list(m_ref, error_p):
     return l_new, middle_ref, e_dict, e_count
 
 
-def error_list(m_ref, m_model, m_ht_list, error_p, trans_p, fastq):
+def compile_ecdf(ecdf_dict):
+    # Each lane of an ECDF from read_ecdf as sorted lists for bisect: upper probabilities (the last one open so
+    # p is always in a bin), lower probabilities, probability widths, lower values and value widths
+    # (Modified for SQANTI-SIM)
+    tables = {}
+    for lane, bins in ecdf_dict.items():
+        keys = sorted(bins.keys())
+        tables[lane] = ([k[1] for k in keys[:-1]] + [float("inf")], [k[0] for k in keys], [k[1] - k[0] for k in keys],
+                        [bins[k][0] for k in keys], [bins[k][1] - bins[k][0] for k in keys])
+    return tables
+
+
+def ecdf_value(table, p):
+    # Value of the bin with p0 < p <= p1, interpolated as in the original loop over the ECDF bins
+    p1, p0, dp, v0, dv = table
+    i = bisect_left(p1, p)
+    return int(math.floor((p - p0[i]) / dp[i] * dv[i] + v0[i]))
+
+
+def compile_error_model(m_model, m_ht_list, error_p, trans_p):
+    # Markov error model compiled once in read_profile (Modified for SQANTI-SIM):
+    # - transitions: cumulative mis/ins thresholds of each previous error state
+    # - first match: the table of the first lane of the first match ECDF
+    # - match lengths: lane tables sorted by their lower bound, the last lane is used out of range as before
+    trans = {}
+    for state, ranges in trans_p.items():
+        bounds = dict((v, k) for k, v in ranges.items())
+        trans[state] = (bounds["mis"][1], bounds["ins"][1])
+
+    match_tables = compile_ecdf(m_model)
+    lanes = sorted(m_model.keys())
+    return {"trans": trans,
+            "first_match": compile_ecdf(m_ht_list)[list(m_ht_list.keys())[0]],
+            "lane_lo": [lane[0] for lane in lanes],
+            "lane_hi": [lane[1] for lane in lanes],
+            "lane_tables": [match_tables[lane] for lane in lanes],
+            "last_table": match_tables[list(m_model.keys())[-1]],
+            "error_p": error_p}
+
+
+def error_steps(error_p, n):
+    # Blocks of n step sizes of each error type
+    return {"mis": mm.pois_geom_rvs(error_p["mis"][0], error_p["mis"][2], error_p["mis"][3], n).tolist(),
+            "ins": mm.wei_geom_rvs(error_p["ins"][0], error_p["ins"][1], error_p["ins"][2], error_p["ins"][3],
+                                   n).tolist(),
+            "del": mm.wei_geom_rvs(error_p["del"][0], error_p["del"][1], error_p["del"][2], error_p["del"][3],
+                                   n).tolist()}
+
+
+def error_list(m_ref, e_model, fastq):
     # l_old is the original length, and l_new is used to control the new length after introducing errors
     l_new = m_ref
     pos = 0
@@ -1776,15 +2124,25 @@ def error_list(m_ref, m_model, m_ht_list, error_p, trans_p, fastq):
     middle_ref = m_ref
     prev_error = "start"
     e_count = {"mis": 0, "ins": 0, "match": 0}
+    trans = e_model["trans"]
+    lane_lo = e_model["lane_lo"]
+    lane_hi = e_model["lane_hi"]
+    lane_tables = e_model["lane_tables"]
+    last_table = e_model["last_table"]
+
+    # Random numbers of the read are drawn in blocks, extended if the read needs more (Modified for SQANTI-SIM)
+    n_block = m_ref // ERROR_BLOCK_LEN + 1
+    rand = np.random.random(2 * n_block + 1).tolist()
+    n_rand = len(rand)
+    i_rand = 1
+    steps = error_steps(e_model["error_p"], n_block)
+    i_step = {"mis": 0, "ins": 0, "del": 0}
+    n_step = n_block
 
     # The first match come from m_ht_list
-    p = random.random()
-    k1 = list(m_ht_list.keys())[0]
-    for k2, v2 in m_ht_list[k1].items():
-        if k2[0] < p <= k2[1]:
-            prev_match = int(np.floor((p - k2[0]) / (k2[1] - k2[0]) * (v2[1] - v2[0]) + v2[0]))
-            if prev_match < 2:
-                prev_match = 2
+    prev_match = ecdf_value(e_model["first_match"], rand[0])
+    if prev_match < 2:
+        prev_match = 2
     pos += prev_match
     if fastq:
         if prev_match > middle_ref: 
@@ -1794,20 +2152,30 @@ def error_list(m_ref, m_model, m_ht_list, error_p, trans_p, fastq):
 
     # Select an error, then the step size, and then a match and so on so forth.
     while pos < middle_ref:
+        if i_rand + 2 > n_rand:
+            rand.extend(np.random.random(2 * n_block).tolist())
+            n_rand = len(rand)
+
         # pick the error based on Markov chain
-        p = random.random()
-        for k in trans_p[prev_error].keys():
-            if k[0] <= p < k[1]:
-                error = trans_p[prev_error][k]
-                break
+        p = rand[i_rand]
+        t_mis, t_ins = trans[prev_error]
+        if p < t_mis:
+            error = "mis"
+        elif p < t_ins:
+            error = "ins"
+        else:
+            error = "del"
 
-        if error == "mis":
-            step = mm.pois_geom(error_p[error][0], error_p[error][2], error_p[error][3])
-        elif error == "ins":
-            step = mm.wei_geom(error_p[error][0], error_p[error][1], error_p[error][2], error_p[error][3])
+        if i_step[error] == n_step:
+            for e, block in error_steps(e_model["error_p"], n_block).items():
+                steps[e].extend(block)
+            n_step += n_block
+        step = steps[error][i_step[error]]
+        i_step[error] += 1
+
+        if error == "ins":
             l_new += step
-        else:
-            step = mm.wei_geom(error_p[error][0], error_p[error][1], error_p[error][2], error_p[error][3])
+        elif error == "del":
             l_new -= step
 
         if error != "ins":
@@ -1826,14 +2194,13 @@ def error_list(m_ref, m_model, m_ht_list, error_p, trans_p, fastq):
                 e_count[error] += step
 
         # Randomly select a match length
-        for k1 in m_model.keys():
-            if k1[0] <= prev_match < k1[1]:
-                break
-        p = random.random()
-        for k2, v2 in m_model[k1].items():
-            if k2[0] < p <= k2[1]:
-                step = int(np.floor((p - k2[0]) / (k2[1] - k2[0]) * (v2[1] - v2[0]) + v2[0]))
-                break
+        i = bisect_right(lane_lo, prev_match) - 1
+        p1, p0, dp, v0, dv = lane_tables[i] if i >= 0 and prev_match < lane_hi[i] else last_table
+        p = rand[i_rand + 1]
+        i = bisect_left(p1, p)
+        step = int(math.floor((p - p0[i]) / dp[i] * dv[i] + v0[i]))
+        i_rand += 2
+
         # there are no two 0 base matches together
         if prev_match == 0 and step == 0:
             step = 1
@@ -1854,7 +2221,7 @@ def error_list(m_ref, m_model, m_ht_list, error_p, trans_p, fastq):
     return l_new, middle_ref, e_dict, e_count
 
 
-def mutate_read(read, read_name, error_log, e_dict, e_count, basecaller, read_type, fastq, k):
+def mutate_read(read, read_name, error_log, e_dict, e_count, basecaller, read_type, fastq, k, n_errors=None):
     if k:  # First remove any errors that land in hp regions
         pattern = "A{" + re.escape(str(k)) + ",}|C{" + re.escape(str(k)) + ",}|G{" + re.escape(str(k)) + ",}|T{" + \
                   re.escape(str(k)) + ",}"
@@ -1892,67 +2259,86 @@ def mutate_read(read, read_name, error_log, e_dict, e_count, basecaller, read_ty
         ins_quals = mm.trunc_lognorm_rvs("ins", read_type, basecaller, e_count["ins"]).tolist()
         match_quals = mm.trunc_lognorm_rvs("match", read_type, basecaller, e_count["match"]).tolist()
 
-    # Mutate read
-    quals = []
-    prev = len(read)
-    for key in sorted(new_e_dict.keys(), reverse=True):
-        val = new_e_dict[key]
-        key = math.ceil(key)  # Ceil instead of round for consistent match calculations during base qual sim
-        err_quals = []
-
-        if val[0] == "mis":
-            ref_base = read[key: key + val[1]]
-            new_bases = ""
-            for i in xrange(val[1]):
-                tmp_bases = list(BASES)
-                tmp_bases.remove(read[key + i])
-                # tmp_bases.remove(read[key]) ## Edited this part for testing
-                new_base = random.choice(tmp_bases)
-                new_bases += new_base
-                if fastq:
-                    err_quals.append(mis_quals.pop())
-
-            new_read = read[:key] + new_bases + read[key + val[1]:]
-            err_end = key + val[1]
-
-        elif val[0] == "del":
-            new_bases = val[1] * "-"
-            ref_base = read[key: key + val[1]]
-            new_read = read[: key] + read[key + val[1]:]
-            err_end = key + val[1]
-
-        elif val[0] == "ins":
-            ref_base = val[1] * "-"
-            new_bases = ""
-            for i in xrange(val[1]):
-                new_base = random.choice(BASES)
-                new_bases += new_base
-                if fastq:
-                    err_quals.append(ins_quals.pop())
-            new_read = read[:key] + new_bases + read[key:]
-            err_end = key
+    # Mutate read in a single left-to-right pass, unchanged segments and new bases are joined once (Modified for SQANTI-SIM)
+    errors = [(math.ceil(key), new_e_dict[key][0], new_e_dict[key][1]) for key in sorted(new_e_dict.keys())]
+    mis_bases = mutate_bases("".join([read[key: key + length] for key, err, length in errors if err == "mis"]))
+    ins_bases = random_bases(sum([length for key, err, length in errors if err == "ins"]))
+
+    segments = []
+    gaps = []  # Length of the match before each error and after the last one
+    log_rows = []
+    cursor = 0
+    mis_pos = 0
+    ins_pos = 0
+    for key, err, length in errors:
+        segments.append(read[cursor: key])
+        gaps.append(max(key - cursor, 0))
+
+        if err == "mis":
+            ref_base = read[key: key + length]
+            new_bases = mis_bases[mis_pos: mis_pos + length]
+            mis_pos += length
+            cursor = key + length
+
+        elif err == "del":
+            new_bases = length * "-"
+            ref_base = read[key: key + length]
+            cursor = key + length
+
+        elif err == "ins":
+            ref_base = length * "-"
+            new_bases = ins_bases[ins_pos: ins_pos + length]
+            ins_pos += length
+            cursor = key
+
+        if err != "del":
+            segments.append(new_bases)
+        if err != "match" and error_log:
+            log_rows.append(read_name + "\t" + str(key) + "\t" + err + "\t" + str(length) +
+                            "\t" + ref_base + "\t" + new_bases + "\n")
 
-        if fastq:
-            if err_end != prev:  # Match after error
-                for j in xrange(prev - err_end):
-                    quals.append(match_quals.pop())
-            quals += err_quals
+    segments.append(read[cursor:])
+    gaps.append(max(len(read) - cursor, 0))
+    read = "".join(segments)
 
-        read = new_read
-        prev = key
+    if n_errors is not None:  # Bases of each error type for the ground truth store (Modified for SQANTI-SIM)
+        for key, err, length in errors:
+            if err in n_errors:
+                n_errors[err] += length
 
-        if val[0] != "match" and error_log:
-            error_log.write(read_name + "\t" + str(key) + "\t" + val[0] + "\t" + str(val[1]) +
-                            "\t" + ref_base + "\t" + new_bases + "\n")
+    if log_rows:  # Same row order as the original backward pass
+        log_rows.reverse()
+        error_log.write("".join(log_rows))
 
-    if fastq:  # Add first match quals
-        while len(match_quals) > 0:
-            quals.append(match_quals.pop())
+    quals = []
+    if fastq:  # Quals in read order taken from the end of each list, the match before the first error takes the rest
+        i_match = len(match_quals) - sum(gaps[1:])
+        quals = match_quals[: i_match]
+        i_mis = len(mis_quals) - mis_pos
+        i_ins = len(ins_quals) - ins_pos
+        for (key, err, length), gap in zip(errors, gaps[1:]):
+            if err == "mis":
+                quals += mis_quals[i_mis: i_mis + length]
+                i_mis += length
+            elif err == "ins":
+                quals += ins_quals[i_ins: i_ins + length]
+                i_ins += length
+            quals += match_quals[i_match: i_match + gap]
+            i_match += gap
 
-    quals.reverse()
     return read, quals
 
 
+def mutate_bases(ref_bases):
+    # A different random base for each reference base (Modified for SQANTI-SIM)
+    idx = BASES_IDX[np.frombuffer(ref_bases.encode(), dtype=np.uint8)]
+    return BASES_ARRAY[(idx + np.random.randint(1, 4, size=len(idx))) % 4].tobytes().decode()
+
+
+def random_bases(n):
+    return BASES_ARRAY[np.random.randint(0, 4, size=n)].tobytes().decode()
+
+
 def inflate_abun(original_dict, inflated_species):
     rest_abun = (1 - original_dict[inflated_species]) * abun_inflation
     inflated_prob = 1 - rest_abun
@@ -2060,6 +2446,16 @@ def main():
                           default=1)
     parser_t.add_argument('--uracil', help='Converts the thymine (T) bases to uracil (U) in the output fasta format',
                           action='store_true', default=False)
+    parser_t.add_argument('--read_to_isoform', help='Names reads <transcript>_<output name>_read_<number> and writes '
+                                                    'the read-to-isoform table and the simulated counts of each '
+                                                    'transcript (Modified for SQANTI-SIM)',
+                          action='store_true', default=False)
+    parser_t.add_argument('--truth_store', help='Writes the ground truth of each read to a NumPy structured array '
+                                                '<output>_truth.npy (Modified for SQANTI-SIM)',
+                          action='store_true', default=False)
+    parser_t.add_argument('--no_error_profile', help='Does not write the error profile of the aligned reads '
+                                                     '(Modified for SQANTI-SIM)', action='store_false', default=True,
+                          dest='error_profile')
 
     parser_mg = subparsers.add_parser('metagenome', help="Run the simulator on metagenome mode")
     parser_mg.add_argument('-gl', '--genome_list', help="Reference metagenome list, tsv file, the first column is "
@@ -2218,7 +2614,7 @@ def main():
         number_unaligned = number_unaligned_l[0]
         max_len = min(max_len, max_chrom)
         simulation(args.mode, out, dna_type, perfect, kmer_bias, basecaller, "DNA", max_len, min_len, num_threads,
-                   fastq, median_len, sd_len, chimeric=chimeric)
+                   fastq, median_len, sd_len, chimeric=chimeric, seed=args.seed)
 
     elif args.mode == "transcriptome":
         ref_g = args.ref_g
@@ -2300,6 +2696,9 @@ def main():
         print("polya", polya)
         print("fastq", fastq)
         print("num_threads", num_threads)
+        print("read_to_isoform", args.read_to_isoform)
+        print("truth_store", args.truth_store)
+        print("error_profile", args.error_profile)
 
         sys.stdout.write(strftime("%Y-%m-%d %H:%M:%S") + ': ' + ' '.join(sys.argv) + '\n')
         sys.stdout.flush()
@@ -2315,7 +2714,9 @@ def main():
         number_unaligned = number_unaligned_l[0]
         max_len = min(max_len, max_chrom)
         simulation(args.mode, out, dna_type, perfect, kmer_bias, basecaller, read_type, max_len, min_len, num_threads,
-                   fastq, None, None, model_ir, uracil, polya, exp=exp)
+                   fastq, None, None, model_ir, uracil, polya, exp=exp, seed=args.seed,
+                   read_to_isoform=args.read_to_isoform, truth_store=args.truth_store,
+                   error_profile=args.error_profile)
 
     elif args.mode == "metagenome":
         genome_list = args.genome_list
@@ -2440,7 +2841,7 @@ def main():
             number_unaligned = number_unaligned_l[s]
             max_len = min(max_len, max(max_chrom.values()))
             simulation(args.mode, out + "_" + sample, "metagenome", perfect, kmer_bias, basecaller, "DNA", max_len,
-                       min_len, num_threads, fastq, median_len, sd_len, chimeric=chimeric)
+                       min_len, num_threads, fastq, median_len, sd_len, chimeric=chimeric, seed=args.seed)
 
     sys.stdout.write(strftime("%Y-%m-%d %H:%M:%S") + ": Finished!\n")
     sys.stdout.close()
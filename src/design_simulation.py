@@ -8,6 +8,8 @@ the simulation step
 Author: Jorge Mestre Tomas (jormart2@alumni.uv.es)
 """
 
+import json
+import multiprocessing as mp
 import numpy
 import os
 import pandas
@@ -15,12 +17,49 @@ import pysam
 import random
 import subprocess
 import sys
+import tempfile
 from bisect import bisect_left
 from collections import defaultdict
+from src.transcript_cache import cached_file_hash, get_transcriptome
 
 MIN_SIM_LEN = 200 # Minimum length of transcripts to simulate
 
-def target_trans(f_idx: str, f_idx_out: str, counts: dict) -> tuple:
+def read_trans_index(f_idx: str) -> tuple:
+    """Parses the transcript index file generated in the classif step
+
+    Args:
+        f_idx (str): name of the transcript index file
+
+    Returns:
+        col_names (list): column names of the index file
+        trans_by_SC (dict): index rows of each structural category
+        trans_by_gene (dict): index rows of each gene
+        trans_index (pandas.DataFrame): complete index table
+    """
+
+    trans_by_SC = defaultdict(lambda: [])
+    trans_by_gene = defaultdict(lambda: [])
+
+    # Build a dict with all transcripts classified in each structural category
+    with open(f_idx, "r") as cat:
+        col_names = cat.readline()
+        col_names = col_names.split()
+        for line in cat:
+            line_split = line.split()
+            gene = line_split[1]
+            SC = line_split[2]
+
+            trans_by_SC[SC].append(tuple(line_split))
+            trans_by_gene[gene].append(tuple(line_split))
+
+    cat.close()
+
+    trans_index = pandas.read_csv(f_idx, sep="\t", header=0, dtype={"chrom":str})
+
+    return col_names, dict(trans_by_SC), dict(trans_by_gene), trans_index
+
+
+def target_trans(f_idx: str, f_idx_out: str, counts: dict, index: tuple = None) -> tuple:
     """
     Choose those transcripts that will be deleted from the original GTF
     to generate the modified file that will be used as the reference annotation
@@ -30,6 +69,8 @@ def target_trans(f_idx: str, f_idx_out: str, counts: dict) -> tuple:
         f_idx_out (str): name of the output transcript index file
         counts (dict): dictinary with the number of transcripts of each
                        structural category to be deleted
+        index (tuple): already parsed index file (from read_trans_index),
+                       it is not modified so it can be reused between designs
     Returns:
         final_target (set): all transcripts to be simulated (deleted from GTF)
     """
@@ -40,28 +81,23 @@ def target_trans(f_idx: str, f_idx_out: str, counts: dict) -> tuple:
         else:
             return "known"
 
+    if index is None:
+        index = read_trans_index(f_idx)
+    col_names, index_by_SC, index_by_gene, trans_index = index
+
+    # Work on copies, transcripts are popped while choosing the targets
     trans_by_SC = defaultdict(lambda: [])
+    for SC in index_by_SC:
+        trans_by_SC[SC] = list(index_by_SC[SC])
     trans_by_gene = defaultdict(lambda: [])
+    for gene in index_by_gene:
+        trans_by_gene[gene] = list(index_by_gene[gene])
 
     target_trans = set()
     target_genes = set()
     ref_trans = set()
     ref_genes = set()
 
-    # Build a dict with all transcripts classified in each structural category
-    with open(f_idx, "r") as cat:
-        col_names = cat.readline()
-        col_names = col_names.split()
-        for line in cat:
-            line_split = line.split()
-            gene = line_split[1]
-            SC = line_split[2]
-
-            trans_by_SC[SC].append(tuple(line_split))
-            trans_by_gene[gene].append(tuple(line_split))
-
-    cat.close()
-
     # Select randomly the transcripts of each SC that are going to be deleted
     # It's important to make sure you don't delete its reference trans or gene
     categories = list(counts.keys())
@@ -143,7 +179,7 @@ def target_trans(f_idx: str, f_idx_out: str, counts: dict) -> tuple:
                 if len(trans_by_gene[gene]) == 0:
                     final_target.add(gene)
 
-    trans_index = pandas.read_csv(f_idx, sep="\t", header=0, dtype={"chrom":str})
+    trans_index = trans_index.copy()
     trans_index["sim_type"] = trans_index.apply(pick_sim_type, axis=1)
     trans_index["sim_type"] = trans_index["sim_type"].fillna("NA")
     trans_index.to_csv(
@@ -220,10 +256,42 @@ def modifyGTF(f_name_in: str, f_name_out: str, target: list):
     return
 
 
-def simulate_gtf(args):
-    """Generates the modified reference annotation"""
+def modifyGTF_batch(f_name_in: str, designs: list):
+    """
+    Writes the modified GTF of several designs in a single pass over the
+    original GTF
+
+    Args:
+        f_name_in (str) file name of the reference annotation GTF
+        designs (list) tuples with the file name of each modified GTF and the
+                       transcripts that will be deleted from it
+    """
+
+    f_outs = [(open(f_name_out, "w"), target) for f_name_out, target in designs]
+
+    with open(f_name_in, "r") as gtf_in:
+        for line in gtf_in:
+            if line.startswith("#"):
+                for f_out, target in f_outs:
+                    f_out.write(line)
+            else:
+                gene_id = getGeneID(line)
+                trans_id = getTransID(line)
+                for f_out, target in f_outs:
+                    if gene_id in target or trans_id in target:
+                        pass
+                    else:
+                        f_out.write(line)
+    gtf_in.close()
+    for f_out, target in f_outs:
+        f_out.close()
+
+    return
+
+
+def novel_counts(args) -> dict:
+    """Number of transcripts of each structural category to delete"""
 
-    print("[SQANTI-SIM] Writting modified GTF")
     counts = defaultdict(
         lambda: 0,
         {
@@ -239,6 +307,15 @@ def simulate_gtf(args):
         },
     )
 
+    return counts
+
+
+def simulate_gtf(args):
+    """Generates the modified reference annotation"""
+
+    print("[SQANTI-SIM] Writting modified GTF")
+    counts = novel_counts(args)
+
     gtf_modif = os.path.join(args.dir, (args.output + "_modified.gtf"))
     f_idx_out = os.path.join(args.dir, (args.output + "_index.tsv"))
 
@@ -299,6 +376,68 @@ def take_closest(my_list: list, number: int)-> int:
     else:
         return pos
 
+def count_primary_alignments(aln_file) -> dict:
+    """Raw counts per transcript counting only primary alignments
+
+    Args:
+        aln_file (pysam.AlignmentFile) opened SAM/BAM/CRAM file or stream
+
+    Returns:
+        trans_counts (dict) number of primary alignments of each transcript
+    """
+
+    trans_counts = defaultdict(lambda: 0)
+    for align in aln_file:
+        if (
+            align.reference_id == -1
+            or align.is_supplementary
+            or align.is_secondary
+        ):
+            continue
+        trans_counts[align.reference_name] += 1
+
+    return trans_counts
+
+
+def stream_alignment_counts(cmd: list) -> dict:
+    """Counts primary alignments reading the SAM output of an aligner
+
+    The command must write SAM records to stdout (i.e. minimap2 without -o).
+    Alignments are counted as they are produced, so no SAM file is written
+
+    Args:
+        cmd (list) aligner command and its arguments
+
+    Returns:
+        trans_counts (dict) number of primary alignments of each transcript
+    """
+
+    sys.stdout.flush()
+    f_err = tempfile.TemporaryFile()
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=f_err)
+    trans_counts = None
+    try:
+        with pysam.AlignmentFile(proc.stdout, "r") as sam_in:
+            trans_counts = count_primary_alignments(sam_in)
+    except (ValueError, OSError):
+        pass  # No valid SAM output, reported below with the aligner messages
+    finally:
+        proc.stdout.close()
+        return_code = proc.wait()
+
+    if return_code != 0 or trans_counts is None:
+        f_err.seek(0)
+        err_msg = f_err.read().decode(errors="replace").strip()
+        f_err.close()
+        print("[SQANTI-SIM] ERROR running aligner (exit code %s): %s" %(return_code, " ".join(cmd)), file=sys.stderr)
+        if err_msg:
+            print(err_msg, file=sys.stderr)
+        sys.exit(1)
+    f_err.close()
+
+    return trans_counts
+
+
 def create_expr_file_fixed_count(f_idx: str, args: list):
     """ Expression matrix - equal mode
 
@@ -426,48 +565,37 @@ def create_expr_file_nbinom(f_idx: str, args: list):
     trans_index.to_csv(f_idx, sep="\t", header=True, index=False, na_rep="NA")
 
 
-def create_expr_file_sample(f_idx: str, args: list, tech: str):
-    """ Expression matrix - sample mode
+def expr_from_reads(args: list, tech: str) -> dict:
+    """Counts the reads of each transcript in a real sample
 
-    Modifies the index file adding the counts and TPM for the transcripts that
-    will be simulated using a real expression distribution
+    Extracts the transcript sequences of the reference annotation and counts
+    the primary alignments of the real reads against them
 
     Args:
-        f_idx (str) index file name
-        args (list) reference transcriptome and real reads
+        args (list) reference annotation, genome and real reads
         tech (str) sequencing platform {pb, ont}
-    """
 
-    def sample_coverage(row):
-        if row["transcript_id"] in novel_trans:
-            coverage = novel_expr.pop()
-        elif row["transcript_id"] in known_trans:
-            coverage = known_expr.pop()
-        else:
-            coverage = 0
-        return coverage
+    Returns:
+        trans_counts (dict) number of reads of each transcript
+    """
 
     # Extract fasta transcripts
-    ref_t = os.path.splitext(args.gtf)[0] + ".transcripts.fa"
-    if os.path.exists(ref_t):
-        print("[SQANTI-SIM] WARNING: %s already exists. Overwritting!" %(ref_t), file=sys.stderr)
-
-    cmd = ["gffread", "-w", str(ref_t), "-g", str(args.genome), str(args.gtf)]
-    cmd = " ".join(cmd)
-    sys.stdout.flush()
-    if subprocess.check_call(cmd, shell=True) != 0:
-        print("[SQANTI-SIM] ERROR running gffread: {0}".format(cmd), file=sys.stderr)
-        sys.exit(1)
+    ref_t = get_transcriptome(args.gtf, args.genome, args.cache_dir)
 
     if args.mapped_reads:
-        sam_file = args.mapped_reads
         if not os.path.exists(args.mapped_reads):
             print("[SQANTI-SIM] ERROR: %s does not exist" %(args.mapped_reads), file=sys.stderr)
             sys.exit(1)
+
+        # SAM, BAM or CRAM (format is detected by pysam)
+        with pysam.AlignmentFile(
+            args.mapped_reads, "r", threads=args.cores, reference_filename=ref_t
+        ) as aln_in:
+            trans_counts = count_primary_alignments(aln_in)
     else:
         # Align with minimap
         if tech == "pb":
-            sam_file = os.path.join(args.dir, (os.path.splitext(os.path.basename(args.pb_reads))[0] + "_sqanti-sim_align.sam"))
+            reads = args.pb_reads
             cmd = [
                 "minimap2",
                 ref_t,
@@ -476,13 +604,11 @@ def create_expr_file_sample(f_idx: str, args: list, tech: str):
                 "map-pb",
                 "-a",
                 "--secondary=no",
-                "-o",
-                sam_file,
                 "-t",
                 str(args.cores),
             ]
         elif tech == "ont":
-            sam_file = os.path.join(args.dir, (os.path.splitext(os.path.basename(args.ont_reads))[0] + "_sqanti-sim_align.sam"))
+            reads = args.ont_reads
             cmd = [
                 "minimap2",
                 ref_t,
@@ -491,41 +617,151 @@ def create_expr_file_sample(f_idx: str, args: list, tech: str):
                 "map-ont",
                 "-a",
                 "--secondary=no",
-                "-o",
-                sam_file,
                 "-t",
                 str(args.cores),
             ]
 
-        cmd = " ".join(cmd)
-        sys.stdout.flush()
-        if subprocess.check_call(cmd, shell=True) != 0:
-            print("[SQANTI-SIM] ERROR running minimap2: {0}".format(cmd), file=sys.stderr)
-            sys.exit(1)
-
-    # Raw counts -> Count only primary alignments
-    trans_counts = defaultdict(lambda: 0)
-    with pysam.AlignmentFile(sam_file, "r") as sam_file_in:
-        for align in sam_file_in:
-            trans_id = align.reference_name
-
-            if (
-                align.reference_id == -1
-                or align.is_supplementary
-                or align.is_secondary
-            ):
-                continue
-            trans_counts[trans_id] += 1
+        if args.stream_align:
+            # Count on the fly from minimap2 stdout, no SAM written to disk
+            trans_counts = stream_alignment_counts(cmd)
+        else:
+            sam_file = os.path.join(args.dir, (os.path.splitext(os.path.basename(reads))[0] + "_sqanti-sim_align.sam"))
+            cmd.extend(["-o", sam_file])
+            cmd = " ".join(cmd)
+            sys.stdout.flush()
+            if subprocess.check_call(cmd, shell=True) != 0:
+                print("[SQANTI-SIM] ERROR running minimap2: {0}".format(cmd), file=sys.stderr)
+                sys.exit(1)
+
+            with pysam.AlignmentFile(sam_file, "r") as sam_file_in:
+                trans_counts = count_primary_alignments(sam_file_in)
     #os.remove(sam_file)
     #os.remove(ref_t)
 
+    return trans_counts
+
+
+def expr_profile_key(args: list) -> dict:
+    """Hashes of the inputs used to compute an expression profile
+
+    Args:
+        args (list) reference annotation, genome and real reads
+
+    Returns:
+        key (dict) MD5 of the reads (or aligned reads), GTF and genome
+    """
+
+    reads = args.pb_reads or args.ont_reads or args.mapped_reads
+    key = {
+        "reads": cached_file_hash(reads, args.cache_dir) if reads else None,
+        "gtf": cached_file_hash(args.gtf, args.cache_dir),
+        "genome": cached_file_hash(args.genome, args.cache_dir),
+    }
+
+    return key
+
+
+def get_expr_profile(args: list, tech: str) -> dict:
+    """Read counts of each transcript in a real sample
+
+    Loads the counts from --expr_profile if the file exists, so the reads
+    are not aligned again. Otherwise the reads are aligned and counted, and
+    the counts are saved (to --expr_profile or <output>_expr_profile.json)
+    to be reused by later designs with the same reads, GTF and genome.
+    Only the raw counts are cached because the expression distributions
+    depend on the transcripts of each design (see expr_distributions)
+
+    Args:
+        args (list) reference annotation, genome, real reads and profile file
+        tech (str) sequencing platform {pb, ont}
+
+    Returns:
+        trans_counts (dict) number of reads of each transcript
+    """
+
+    key = expr_profile_key(args)
+
+    if args.expr_profile and os.path.exists(args.expr_profile):
+        print("[SQANTI-SIM] Loading expression profile from %s" %(args.expr_profile))
+        with open(args.expr_profile, "r") as f_in:
+            profile = json.load(f_in)
+        f_in.close()
+
+        for k in ["gtf", "genome", "reads"]:
+            if key[k] is None:
+                continue # Reads are not needed when loading a profile
+            if profile["key"][k] != key[k]:
+                print("[SQANTI-SIM] ERROR: the %s used to compute %s is not the same as the current one" %(k, args.expr_profile), file=sys.stderr)
+                sys.exit(1)
+
+        return profile["trans_counts"]
+
+    if key["reads"] is None:
+        print("[SQANTI-SIM] ERROR: --pb_reads, --ont_reads or --mapped_reads are required to compute the expression profile", file=sys.stderr)
+        sys.exit(1)
+
+    trans_counts = dict(expr_from_reads(args, tech))
+
+    if args.expr_profile:
+        f_profile = args.expr_profile
+    else:
+        f_profile = os.path.join(args.dir, (args.output + "_expr_profile.json"))
+    print("[SQANTI-SIM] Saving expression profile in %s" %(f_profile))
+    with open(f_profile, "w") as f_out:
+        json.dump({"key": key, "trans_counts": trans_counts}, f_out)
+    f_out.close()
+
+    return trans_counts
+
+
+def expr_distributions(trans_counts: dict, trans_to_gene: dict) -> tuple:
+    """Empirical expression and isoform complexity distributions
+
+    Args:
+        trans_counts (dict) number of reads of each transcript
+        trans_to_gene (dict) gene of each transcript that can be simulated in the design
+
+    Returns:
+        expr_distr (list) sorted empirical expression values
+        complex_distr (list) expressed isoforms of each expressed gene
+    """
+
     # Empirical expression values
     expr_distr = list(trans_counts.values())
     expr_distr.sort()
-    if args.trans_number:
-        n_trans = args.trans_number
-    else:
-        n_trans = len(expr_distr)
+
+    # Analyze the isoform complexity of expressed genes (dif expressed transcript per gene)
+    gene_isoforms_counts = defaultdict(lambda: 0)
+    for i in trans_counts:
+        gene_id = trans_to_gene.get(i)
+        if gene_id:
+            gene_isoforms_counts[gene_id] += 1
+    complex_distr = list(gene_isoforms_counts.values())
+
+    return expr_distr, complex_distr
+
+
+def create_expr_file_sample(f_idx: str, args: list, tech: str, trans_counts: dict = None):
+    """ Expression matrix - sample mode
+
+    Modifies the index file adding the counts and TPM for the transcripts that
+    will be simulated using a real expression distribution
+
+    Args:
+        f_idx (str) index file name
+        args (list) reference transcriptome and real reads
+        tech (str) sequencing platform {pb, ont}
+        trans_counts (dict) read counts already computed (get_expr_profile)
+    """
+
+    def sample_coverage(row):
+        if row["transcript_id"] in novel_trans:
+            coverage = novel_expr.pop()
+        elif row["transcript_id"] in known_trans:
+            coverage = known_expr.pop()
+        else:
+            coverage = 0
+        return coverage
 
     # Read transcripts from index file
     novel_trans = []
@@ -554,6 +790,15 @@ def create_expr_file_sample(f_idx: str, args: list, tech: str):
                 trans_by_gene[line[k]].append(line[j])
     f_in.close()
 
+    # Empirical expression values of the transcripts of this design
+    if trans_counts is None:
+        trans_counts = get_expr_profile(args, tech)
+    expr_distr, complex_distr = expr_distributions(trans_counts, trans_to_gene)
+    if args.trans_number:
+        n_trans = args.trans_number
+    else:
+        n_trans = len(expr_distr)
+
     if n_trans < len(novel_trans):
         n_trans = len(novel_trans)
         print("[SQANTI-SIM] ERROR: -nt/--trans number must be higher than the novel transcripts to simulate")
@@ -566,14 +811,6 @@ def create_expr_file_sample(f_idx: str, args: list, tech: str):
     # Simulate also the number of different isoforms simulated for the same gene
     # If not iso_complex the known transcripts to simulate are chosen randomly
     if args.iso_complex:
-        # Analyze the isoform complexity of expressed genes (dif expressed transcript per gene)
-        gene_isoforms_counts = defaultdict(lambda: 0)
-        for i in trans_counts:
-            gene_id = trans_to_gene[i]
-            if gene_id:
-                gene_isoforms_counts[gene_id] += 1
-        complex_distr = list(gene_isoforms_counts.values())
-
         # Sample random values from empirical distribution:
         # (1) Minimum get one for each novel gene to simulate
         # (2) Keep taking from known transcript till args.trans_number is satisfied
@@ -689,4 +926,88 @@ def create_expr_file_sample(f_idx: str, args: list, tech: str):
 
     print("[SQANTI-SIM] Requested transcripts: %s" %(n_trans))
     print("[SQANTI-SIM] Requested reads: %s" %(n_reads))
-    
\ No newline at end of file
+    
+
+
+def init_design_worker(index: tuple, profile: dict):
+    """Shares the parsed index and read counts of the real sample with the workers"""
+
+    global design_index, design_profile
+    design_index = index
+    design_profile = profile
+
+
+def design_worker(args) -> tuple:
+    """Generates the index and expression values of one design
+
+    Args:
+        args (list) parameters of the design (output prefix and seed included)
+
+    Returns:
+        target (set) transcripts and genes to delete from the GTF
+        counts (dict) remaining classified transcripts after deletion
+    """
+
+    random.seed(args.seed)
+    numpy.random.seed(args.seed)
+
+    counts = novel_counts(args)
+    f_idx_out = os.path.join(args.dir, (args.output + "_index.tsv"))
+    target = target_trans(args.trans_index, f_idx_out, counts, design_index)
+
+    if args.mode == "equal":
+        create_expr_file_fixed_count(f_idx_out, args)
+    elif args.mode == "custom":
+        create_expr_file_nbinom(f_idx_out, args)
+    elif args.mode == "sample":
+        tech = "pb" if args.pb_reads else "ont"
+        create_expr_file_sample(f_idx_out, args, tech, design_profile)
+
+    return target, dict(counts)
+
+
+def batch_design(args, designs: list) -> list:
+    """Generates several designs from the same index and reference annotation
+
+    The index file (and the read counts of the real sample in sample mode) is
+    parsed only once, the designs are sampled in parallel and all the modified
+    GTFs are written in a single pass over the reference annotation. The
+    expression distributions are computed by each design from its own index
+
+    Args:
+        args (list) common parameters of all the designs
+        designs (list) parameters of each design
+
+    Returns:
+        counts_end (list) remaining classified transcripts of each design
+    """
+
+    print("[SQANTI-SIM] Reading transcript index")
+    index = read_trans_index(args.trans_index)
+
+    profile = None
+    if args.mode == "sample":
+        tech = "pb" if args.pb_reads else "ont"
+        profile = get_expr_profile(args, tech)
+
+    print("[SQANTI-SIM] Sampling %s designs" %(len(designs)))
+    sys.stdout.flush()
+    if args.cores <= 1 or len(designs) == 1:
+        init_design_worker(index, profile)
+        results = [design_worker(d) for d in designs]
+    else:
+        pool = mp.Pool(min(args.cores, len(designs)), init_design_worker, (index, profile))
+        results = pool.map(design_worker, designs)
+        pool.close()
+        pool.join()
+
+    print("[SQANTI-SIM] Writting modified GTFs")
+    modifyGTF_batch(
+        args.gtf,
+        [
+            (os.path.join(d.dir, (d.output + "_modified.gtf")), target)
+            for d, (target, counts) in zip(designs, results)
+        ],
+    )
+
+    return [counts for target, counts in results]
@@ -14,25 +14,47 @@ import pandas
 import pysam
 import random
 import re
+import shutil
 import subprocess
 import sys
 from collections import defaultdict
+from src.IsoSeqSim.utilities import py_isoseqsim_engine as isoseqsim
+from src.transcript_cache import get_transcriptome, subset_transcriptome
+
+
+def extract_transcripts(args, trans_ids: set, ref_t: str):
+    """Writes the sequences of the transcripts that will be simulated
+
+    The sequences are taken from the shared transcript cache (extracted only
+    once for each GTF and genome), so the rest of the annotated transcripts
+    are not written nor loaded by the simulators
+
+    Args:
+        args (list) reference annotation, genome and cache directory
+        trans_ids (set) transcripts with requested counts
+        ref_t (str) output FASTA file name
+    """
+
+    if os.path.exists(ref_t):
+        print("[SQANTI-SIM] WARNING: %s already exists, it will be overwritten" %(ref_t))
+
+    cache_t = get_transcriptome(args.gtf, args.genome, args.cache_dir)
+    subset_transcriptome(cache_t, trans_ids, ref_t)
 
 
 def pb_simulation(args):
-    """Simulate PacBio reads using the IsoSeqSim pipeline"""
+    """Simulate PacBio reads using the IsoSeqSim pipeline
+
+    IsoSeqSim runs in-process: reads are streamed from the simulation engine and
+    written together with the read-to-isoform file and the transcript counts
+    """
 
     def counts_to_index(row):
         return id_counts[row["transcript_id"]]
     
-    # Generate IsoSeqSim template expression file
-    expr_f = os.path.join(
-        os.path.dirname(os.path.abspath(args.trans_index)),
-        "tmp_expression.tsv",
-    )
+    # IsoSeqSim expression from the index file
+    expr = {}
     index_file_requested_counts = 0
-    f_out = open(expr_f, "w")
-    f_out.write("target_id\test_counts\ttpm\n")
     with open(args.trans_index, "r") as idx:
         header_names = idx.readline()
         header_names = header_names.split()
@@ -42,10 +64,9 @@ def pb_simulation(args):
             line = line.split()
             if int(line[i]) == 0:
                 continue
-            f_out.write(line[0] + "\t" + line[i] + "\t" + line[j] + "\n")
+            expr[line[0]] = float(line[j])
             index_file_requested_counts += int(line[i])
     idx.close()
-    f_out.close()
 
     if not args.long_count:
         args.long_count = index_file_requested_counts
@@ -58,65 +79,45 @@ def pb_simulation(args):
     # PacBio Sequel simulation -> error rates from IsoSeqSim GitHub
     print("[SQANTI-SIM] Simulating PacBio reads with IsoSeqSim")
     src_dir = os.path.dirname(os.path.realpath(__file__))
-    isoseqsim = os.path.join(src_dir, "IsoSeqSim/bin/isoseqsim")
     util_dir = os.path.join(src_dir, "IsoSeqSim/utilities/")
-    cmd = [
-        isoseqsim,
-        "-g",
-        str(args.genome),
-        "-a",
-        str(args.gtf),
-        "--expr",
-        str(expr_f),
-        "--c5",
+    sys.stdout.flush()
+    sim_reads = isoseqsim.simulate_reads(
+        args.genome,
+        args.gtf,
+        expr,
+        args.long_count,
         os.path.join(util_dir, "5_end_completeness.PacBio-Sequel.tab"),
-        "--c3",
         os.path.join(util_dir, "3_end_completeness.PacBio-Sequel.tab"),
-        "-o",
-        os.path.join(args.dir, "PacBio_simulated"),
-        "-t",
-        os.path.join(args.dir, "PacBio_simulated.tsv"),
-        "--es",
-        "0.01731",
-        "--ed",
-        "0.01090",
-        "--ei",
-        "0.02204",
-        "-n",
-        str(args.long_count),
-        "-m",
-        "normal",
-        "--cpu",
-        str(args.cores),
-        "--tempdir",
-        os.path.join(args.dir, "temp_isoseqsim"),
-        "--seed",
-        str(args.seed),
-    ]
-
-    cmd = " ".join(cmd)
-    sys.stdout.flush()
-    if subprocess.check_call(cmd, shell=True) != 0:
-        print("ERROR running IsoSeqSim: {0}".format(cmd), file=sys.stderr)
-        sys.exit(1)
-    os.remove(expr_f)
+        er_sub=0.01731,
+        er_ins=0.02204,
+        er_del=0.01090,
+        cpu=args.cores,
+        seed=args.seed,
+        output_gpd=os.path.join(args.dir, "PacBio_simulated.tsv"),
+        fastq=args.fastq,
+    )
 
-    print("[SQANTI-SIM] Counting PacBio reads")
-    read_to_iso = os.path.join(args.dir, "PacBio_simulated.read_to_isoform.tsv")
-    output_read_info = open(read_to_iso, "w")
+    # Reads, read-to-isoform and counts in a single pass
+    n_read = 0
     id_counts = defaultdict(lambda: 0)
-    isoseqsim_fasta = os.path.join(args.dir, "PacBio_simulated.fasta")
-    with open(isoseqsim_fasta, "r") as sim_fasta:
-        for line in sim_fasta:
-            if line.startswith(">"):
-                line = line.lstrip(">")
-                line_split = line.split("_")
-                trans_id = "_".join(line_split[:-4])
-                output_read_info.write(line + "\t" + trans_id + "\n")
-                id_counts[trans_id] += 1
-    sim_fasta.close()
-    output_read_info.close()
+    if args.fastq:
+        f_reads = open(os.path.join(args.dir, "PacBio_simulated.fastq"), "w", buffering=1 << 20)
+    else:
+        f_reads = open(os.path.join(args.dir, "PacBio_simulated.fasta"), "w", buffering=1 << 20)
+    f_read_info = open(os.path.join(args.dir, "PacBio_simulated.read_to_isoform.tsv"), "w")
+    for trans_id, read_seq, read_qual in sim_reads:
+        read_id = trans_id + "_PacBio_simulated_read_" + str(n_read)
+        if args.fastq:
+            f_reads.write("@" + read_id + "\n" + read_seq + "\n+\n" + read_qual + "\n")
+        else:
+            f_reads.write(">" + read_id + "\n" + read_seq + "\n")
+        f_read_info.write(read_id + "\t" + trans_id + "\n")
+        id_counts[trans_id] += 1
+        n_read += 1
+    f_reads.close()
+    f_read_info.close()
 
+    print("[SQANTI-SIM] Counting PacBio reads")
     trans_index = pandas.read_csv(args.trans_index, sep="\t", header=0, dtype={"chrom":str})
     trans_index["sim_counts"] = trans_index.apply(counts_to_index, axis=1)
     trans_index["sim_counts"] = trans_index["sim_counts"].fillna(0)
@@ -190,18 +191,8 @@ def ont_simulation(args):
             print("[SQANTI-SIM] ERROR: Unpacking NanoSim pre-trained model failed", file=sys.stderr)
             sys.exit(1)
 
-    # Extract fasta transcripts
-    print("[SQANTI-SIM] Extracting transcript sequences")
-    ref_t = os.path.join(os.path.dirname(args.genome), "sqanti-sim.transcripts.fa")
-    if os.path.exists(ref_t):
-        print("[SQANTI-SIM] WARNING: %s already exists, it will be overwritten" %(ref_t))
-
-    cmd = ["gffread", "-w", str(ref_t), "-g", str(args.genome), str(args.gtf)]
-    cmd = " ".join(cmd)
-    sys.stdout.flush()
-    if subprocess.check_call(cmd, shell=True) != 0:
-        print("[SQANTI-SIM] ERROR running gffread: {0}".format(cmd), file=sys.stderr)
-        sys.exit(1)
+    # NanoSim fetches the expressed transcripts from the indexed transcript cache
+    ref_t = get_transcriptome(args.gtf, args.genome, args.cache_dir)
 
     print("[SQANTI-SIM] Simulating ONT reads with NanoSim")
     cmd = [
@@ -229,10 +220,14 @@ def ont_simulation(args):
         str(args.seed),
         "--fastq",
         "--no_model_ir",
+        "--read_to_isoform",
+        "--truth_store",
     ]
 
     if uracil:
         cmd.append("--uracil")
+    if not args.error_profile:
+        cmd.append("--no_error_profile")
 
     cmd = " ".join(cmd)
     sys.stdout.flush()
@@ -241,42 +236,31 @@ def ont_simulation(args):
         sys.exit(1)
     os.remove(expr_f)
 
-    print("[SQANTI-SIM] Counting and renaming ONT reads")
-    fastqs = [
-        os.path.join(args.dir, "ONT_simulated_aligned_reads.fastq"),
-        os.path.join(args.dir, "ONT_simulated_unaligned_reads.fastq"),
-    ]
-
-    n_read = 0
-    pair_id = []
-    id_counts = defaultdict(lambda: 0)
+    # NanoSim already names the reads and writes the read-to-isoform table and counts
+    print("[SQANTI-SIM] Collecting ONT reads and counts")
     f_name = os.path.join(args.dir, "ONT_simulated.fastq")
-    f_out = open(f_name, "w")
-
-    for f in fastqs:
-        f_in = open(f, "r")
-        for line in f_in:
-            if line.startswith("@"):
-                line = line.lstrip("@")
-                trans_id = "_".join(line.split("_")[:-7])
-                id_counts[trans_id] += 1
-                read_id = trans_id + "_ONT_simulated_read_" + str(n_read)
-                n_read += 1
-                pair_id.append((read_id, trans_id))
-
-                f_out.write("@{}\n".format(read_id))
-
-            else:
-                f_out.write(line)
+    os.replace(os.path.join(args.dir, "ONT_simulated_aligned_reads.fastq"), f_name)
+    unaligned = os.path.join(args.dir, "ONT_simulated_unaligned_reads.fastq")
+    with open(f_name, "ab") as f_out, open(unaligned, "rb") as f_in:
+        shutil.copyfileobj(f_in, f_out, 1 << 20)
     f_in.close()
     f_out.close()
+    os.remove(unaligned)
 
-    # Saving counts and read-to-isoform files
-    f_name = os.path.join(args.dir, "ONT_simulated.read_to_isoform.tsv")
-    f_out = open(f_name, "w")
-    for pair in pair_id:
-        f_out.write(str(pair[0]) + "\t" + str(pair[1]) + "\n")
-    f_out.close()
+    os.replace(
+        os.path.join(args.dir, "ONT_simulated_read_to_isoform.tsv"),
+        os.path.join(args.dir, "ONT_simulated.read_to_isoform.tsv"),
+    )
+
+    id_counts = defaultdict(lambda: 0)
+    f_name = os.path.join(args.dir, "ONT_simulated_counts.tsv")
+    with open(f_name, "r") as f_in:
+        f_in.readline()
+        for line in f_in:
+            trans_id, counts = line.split()
+            id_counts[trans_id] = int(counts)
+    f_in.close()
+    os.remove(f_name)
 
     trans_index = pandas.read_csv(args.trans_index, sep="\t", header=0, dtype={"chrom":str})
     trans_index["sim_counts"] = trans_index.apply(counts_to_index, axis=1)
@@ -293,19 +277,6 @@ def illumina_simulation(args):
     def counts_to_index(row):
         return id_counts[row["transcript_id"]]
 
-    # Extract fasta transcripts
-    print("[SQANTI-SIM] Extracting transcript sequences")
-    ref_t = os.path.join(os.path.dirname(args.genome), "sqanti-sim.transcripts.fa")
-    if os.path.exists(ref_t):
-        print("[SQANTI-SIM] WARNING: %s already exists, it will be overwritten" %(ref_t))
-
-    cmd = ["gffread", "-w", str(ref_t), "-g", str(args.genome), str(args.gtf)]
-    cmd = " ".join(cmd)
-    sys.stdout.flush()
-    if subprocess.check_call(cmd, shell=True) != 0:
-        print("[SQANTI-SIM] ERROR running gffread: {0}".format(cmd), file=sys.stderr)
-        sys.exit(1)
-
     # Generate Polyester template expression file
     count_d = defaultdict(float)
     n = 0
@@ -325,6 +296,11 @@ def illumina_simulation(args):
     if not args.short_count:
         args.short_count = n
 
+    # Extract fasta transcripts
+    print("[SQANTI-SIM] Extracting transcript sequences")
+    ref_t = os.path.join(args.dir, "sqanti-sim.transcripts.fa")
+    extract_transcripts(args, set(count_d.keys()), ref_t)
+
     for k in count_d:
         count_d[k] = round((count_d[k] * args.short_count) / 1000000)
 
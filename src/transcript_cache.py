@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+"""
+transcript_cache.py
+
+Shared cache of transcript sequences extracted from a reference annotation.
+The FASTA files are named after the content of the GTF and genome, so they can
+be reused between steps and runs with the same references
+
+Author: Jorge Mestre Tomas (jormart2@alumni.uv.es)
+"""
+
+import fcntl
+import hashlib
+import json
+import os
+import pysam
+import subprocess
+import sys
+import tempfile
+
+CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "sqanti-sim")
+
+
+class CacheLock(object):
+    """Exclusive lock on a cache file shared between processes"""
+
+    def __init__(self, f_name: str):
+        self.f_lock = f_name + ".lock"
+
+    def __enter__(self):
+        self.fd = open(self.f_lock, "w")
+        fcntl.flock(self.fd, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *exc):
+        fcntl.flock(self.fd, fcntl.LOCK_UN)
+        self.fd.close()
+
+
+def file_hash(f_name: str) -> str:
+    """MD5 checksum of a file
+
+    Args:
+        f_name (str) file name
+
+    Returns:
+        checksum (str) hexadecimal MD5 digest of the file content
+    """
+
+    md5 = hashlib.md5()
+    with open(f_name, "rb") as f_in:
+        for block in iter(lambda: f_in.read(1 << 20), b""):
+            md5.update(block)
+    f_in.close()
+
+    return md5.hexdigest()
+
+
+def cached_file_hash(f_name: str, cache_dir: str = CACHE_DIR) -> str:
+    """MD5 checksum of a file, reusing the one computed in previous runs
+
+    Checksums are stored in the cache directory by path, size and modification
+    time, so large genomes are only read again when they change
+
+    Args:
+        f_name (str) file name
+        cache_dir (str) cache directory
+
+    Returns:
+        checksum (str) hexadecimal MD5 digest of the file content
+    """
+
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir, exist_ok=True)
+
+    st = os.stat(f_name)
+    key = "%s:%s:%s" %(os.path.realpath(f_name), st.st_size, st.st_mtime_ns)
+    f_hashes = os.path.join(cache_dir, "hashes.json")
+
+    with CacheLock(f_hashes):
+        hashes = dict()
+        if os.path.exists(f_hashes):
+            with open(f_hashes, "r") as f_in:
+                hashes = json.load(f_in)
+            f_in.close()
+
+        if key not in hashes:
+            hashes[key] = file_hash(f_name)
+            fd, tmp = tempfile.mkstemp(dir=cache_dir, suffix=".json")
+            with os.fdopen(fd, "w") as f_out:
+                json.dump(hashes, f_out)
+            os.replace(tmp, f_hashes)
+
+    return hashes[key]
+
+
+def get_transcriptome(gtf: str, genome: str, cache_dir: str = CACHE_DIR) -> str:
+    """Transcript sequences of the reference annotation
+
+    Extracts all the transcripts with gffread the first time a GTF and genome
+    pair is used. The file is written under a lock and renamed when complete,
+    so parallel runs wait for it instead of extracting it again
+
+    Args:
+        gtf (str) reference annotation GTF
+        genome (str) reference genome FASTA
+        cache_dir (str) cache directory
+
+    Returns:
+        ref_t (str) FASTA file with all the transcripts (indexed)
+    """
+
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir, exist_ok=True)
+
+    gtf_hash = cached_file_hash(gtf, cache_dir)
+    genome_hash = cached_file_hash(genome, cache_dir)
+    ref_t = os.path.join(cache_dir, "%s_%s.transcripts.fa" %(gtf_hash, genome_hash))
+
+    with CacheLock(ref_t):
+        if os.path.exists(ref_t) and os.path.exists(ref_t + ".fai"):
+            print("[SQANTI-SIM] Using cached transcript sequences %s" %(ref_t))
+            return ref_t
+
+        fd, tmp = tempfile.mkstemp(dir=cache_dir, suffix=".fa")
+        os.close(fd)
+        cmd = ["gffread", "-w", str(tmp), "-g", str(genome), str(gtf)]
+        cmd = " ".join(cmd)
+        sys.stdout.flush()
+        if subprocess.call(cmd, shell=True) != 0:
+            os.remove(tmp)
+            print("[SQANTI-SIM] ERROR running gffread: {0}".format(cmd), file=sys.stderr)
+            sys.exit(1)
+
+        pysam.faidx(tmp)
+        os.replace(tmp + ".fai", ref_t + ".fai")
+        os.replace(tmp, ref_t)
+
+    return ref_t
+
+
+def subset_transcriptome(ref_t: str, trans_ids: set, f_out_name: str):
+    """Writes the sequences of some transcripts from the cached transcriptome
+
+    Args:
+        ref_t (str) indexed FASTA file with all the transcripts
+        trans_ids (set) transcripts to write
+        f_out_name (str) output FASTA file name
+    """
+
+    fasta = pysam.FastaFile(ref_t)
+    f_out = open(f_out_name, "w")
+    for trans_id in fasta.references:
+        if trans_id in trans_ids:
+            f_out.write(">" + trans_id + "\n" + fasta.fetch(trans_id) + "\n")
+    f_out.close()
+    fasta.close()
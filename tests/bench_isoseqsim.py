@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+"""Benchmark of the IsoSeqSim per-base error injection (mutate_read)
+
+Compares the per-nucleotide implementation IsoSeqSim had before vectorization
+with the current mutate_read on reads with the PacBio Sequel error rates used
+by SQANTI-SIM. Not collected by pytest, run it as:
+
+    python tests/bench_isoseqsim.py [--length 2000] [--reads 50]
+"""
+
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from test_isoseqsim import ER_DEL, ER_INS, ER_SUB, baseline_mutate_read, load_isoseqsim, random_seq
+
+
+def bench(mutate, n_reads: int) -> float:
+    start = time.perf_counter()
+    for i in range(n_reads):
+        mutate()
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark IsoSeqSim mutate_read")
+    parser.add_argument("--length", type=int, default=2000, help="Read length (default: 2000)")
+    parser.add_argument("--reads", type=int, default=50, help="Number of reads (default: 50)")
+    args = parser.parse_args()
+
+    isoseqsim = load_isoseqsim()
+    error_type, error_prob = isoseqsim.extract_error_rate(ER_SUB, ER_INS, ER_DEL)
+    read_seq = random_seq(args.length, 1)
+    rng = np.random.default_rng(1)
+
+    t_old = bench(lambda: baseline_mutate_read(read_seq, error_type, error_prob), args.reads)
+    t_new = bench(lambda: isoseqsim.mutate_read(read_seq, error_type, error_prob, rng), args.reads)
+
+    print("%d reads of %d bp" %(args.reads, args.length))
+    print("baseline:   %.4f s" %(t_old))
+    print("vectorized: %.4f s" %(t_new))
+    print("speedup:    %.1fx" %(t_old / t_new))
+
+
+if __name__ == "__main__":
+    main()
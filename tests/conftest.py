@@ -0,0 +1,5 @@
+import os
+import sys
+
+# Tests import the modules as sqanti-sim.py does (src.<module>)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,170 @@
+"""Tests of the design step (src/design_simulation.py)"""
+
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+
+import numpy
+import pytest
+
+from src import design_simulation
+
+# The index of the classif step has transcripts of every structural category
+CATEGORIES = ["incomplete-splice_match", "novel_in_catalog", "novel_not_in_catalog", "fusion", "antisense",
+              "genic_intron", "genic", "intergenic"]
+
+
+def write_reference(d: str) -> tuple:
+    """Small GTF, genome and transcript index with several isoforms per gene"""
+
+    rng = random.Random(1)
+    gtf = os.path.join(d, "ref.gtf")
+    genome = os.path.join(d, "genome.fa")
+    idx = os.path.join(d, "ref_index.tsv")
+
+    with open(genome, "w") as f_out:
+        f_out.write(">chr1\n" + "ACGT" * 100 + "\n")
+
+    header = ["transcript_id", "gene_id", "structural_category", "associated_gene", "associated_trans", "chrom",
+              "strand", "exons", "donors", "acceptors", "TSS_genomic_coord", "TTS_genomic_coord", "length"]
+    with open(gtf, "w") as gtf_out, open(idx, "w") as idx_out:
+        idx_out.write("\t".join(header) + "\n")
+        for g in range(1, 41):
+            gene = "G%d" %(g)
+            start = g * 10000
+            for t in range(1, rng.randint(1, 5) + 1):
+                trans = "%s.T%d" %(gene, t)
+                length = rng.choice([150, 400, 900, 1500])
+                if t == 1:
+                    SC, ref_t = "full-splice_match", trans
+                else:
+                    SC, ref_t = rng.choice(CATEGORIES), gene + ".T1"
+                attr = 'gene_id "%s"; transcript_id "%s";' %(gene, trans)
+                for feature in ["transcript", "exon"]:
+                    gtf_out.write("chr1\ttest\t%s\t%d\t%d\t.\t+\t.\t%s\n" %(feature, start, start + length - 1, attr))
+                idx_out.write("\t".join([trans, gene, SC, gene, ref_t, "chr1", "+", "1", "NA", "NA",
+                                         str(start), str(start + length), str(length)]) + "\n")
+
+    return gtf, genome, idx
+
+
+def design_args(d: str, output: str, seed: int) -> argparse.Namespace:
+    """Parameters of a sample mode design with isoform complexity"""
+
+    return argparse.Namespace(
+        mode="sample", trans_index=os.path.join(d, "ref_index.tsv"), gtf=os.path.join(d, "ref.gtf"),
+        genome=os.path.join(d, "genome.fa"), dir=d, output=output, trans_number=40, pb_reads="", ont_reads="",
+        mapped_reads="", expr_profile=os.path.join(d, "profile.json"), cache_dir=os.path.join(d, "cache"),
+        stream_align=False, iso_complex=True, diff_exp=False, low_prob=0.1, high_prob=0.9, ISM=2, NIC=3, NNC=2,
+        Fusion=0, Antisense=0, GG=0, GI=0, Intergenic=0, cores=1, seed=seed, replicates=1, grid=None,
+    )
+
+
+def write_profile(d: str):
+    """Cached read counts of a real sample for the reference of write_reference"""
+
+    args = design_args(d, "profile", 0)
+    rng = random.Random(2)
+    with open(args.trans_index, "r") as f_in:
+        f_in.readline()
+        trans_ids = [line.split()[0] for line in f_in]
+    trans_counts = {trans: rng.randint(1, 50) for trans in trans_ids if rng.random() < 0.7}
+    with open(args.expr_profile, "w") as f_out:
+        json.dump({"key": design_simulation.expr_profile_key(args), "trans_counts": trans_counts}, f_out)
+
+
+def read_file(f_name: str) -> str:
+    with open(f_name, "r") as f_in:
+        return f_in.read()
+
+
+def test_batch_design_matches_single_design(tmp_path):
+    d = str(tmp_path)
+    write_reference(d)
+    write_profile(d)
+
+    # Single design, as run by sqanti-sim.py design
+    args = design_args(d, "single", 12)
+    random.seed(args.seed)
+    numpy.random.seed(args.seed)
+    design_simulation.simulate_gtf(args)
+    design_simulation.create_expr_file_sample(os.path.join(d, "single_index.tsv"), args, "pb")
+
+    # Same parameters and seed as the second row of a batch
+    designs = [design_args(d, "batch1", 11), design_args(d, "batch2", 12)]
+    design_simulation.batch_design(design_args(d, "batch", 11), designs)
+
+    assert read_file(os.path.join(d, "batch2_index.tsv")) == read_file(os.path.join(d, "single_index.tsv"))
+    assert read_file(os.path.join(d, "batch2_modified.gtf")) == read_file(os.path.join(d, "single_modified.gtf"))
+
+
+def test_expr_distributions_use_design_transcripts():
+    trans_counts = {"G1.T1": 5, "G1.T2": 3, "G2.T1": 1, "G3.T1": 8}
+
+    expr_distr, complex_distr = design_simulation.expr_distributions(
+        trans_counts, {"G1.T1": "G1", "G1.T2": "G1", "G2.T1": "G2", "G3.T1": "G3"}
+    )
+    assert expr_distr == [1, 3, 5, 8]
+    assert complex_distr == [2, 1, 1]
+
+    # Same cached counts, but G1.T2 can not be simulated in this design
+    expr_distr, complex_distr = design_simulation.expr_distributions(
+        trans_counts, {"G1.T1": "G1", "G2.T1": "G2", "G3.T1": "G3"}
+    )
+    assert complex_distr == [1, 1, 1]
+
+
+def run_design(args: list) -> subprocess.CompletedProcess:
+    """Run sqanti-sim.py design, which needs cDNA_Cupcake for the classif step"""
+
+    pytest.importorskip("cupcake")
+    script = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "sqanti-sim.py")
+    return subprocess.run([sys.executable, script, "design"] + args, capture_output=True, text=True)
+
+
+def test_grid_columns_accept_flags(tmp_path):
+    d = str(tmp_path)
+    gtf, _, idx = write_reference(d)
+    common = ["equal", "-i", idx, "--gtf", gtf, "-d", d]
+
+    assert run_design(common + ["-o", "single", "-nt", "10", "--NIC", "2", "-s", "3"]).returncode == 0
+
+    grid = os.path.join(d, "grid.tsv")
+    with open(grid, "w") as f_out:
+        f_out.write("name\t--NIC\tnt\ts\n")
+        f_out.write("low\t2\t10\t3\n")
+    assert run_design(common + ["-o", "grid", "--grid", grid]).returncode == 0
+
+    assert read_file(os.path.join(d, "grid_low_index.tsv")) == read_file(os.path.join(d, "single_index.tsv"))
+
+
+def test_grid_rejects_unknown_columns(tmp_path):
+    d = str(tmp_path)
+    gtf, _, idx = write_reference(d)
+
+    grid = os.path.join(d, "grid.tsv")
+    with open(grid, "w") as f_out:
+        f_out.write("name\tgtf\n")
+        f_out.write("x\tother.gtf\n")
+    res = run_design(["equal", "-i", idx, "--gtf", gtf, "-d", d, "--grid", grid])
+
+    assert res.returncode == 1
+    assert "gtf can not be used as a --grid column. Valid columns are: name, Antisense" in res.stderr
+
+
+def test_grid_rows_are_checked(tmp_path):
+    d = str(tmp_path)
+    gtf, _, idx = write_reference(d)
+
+    grid = os.path.join(d, "grid.tsv")
+    with open(grid, "w") as f_out:
+        f_out.write("name\tnbp_known\n")
+        f_out.write("ok\t0.5\n")
+        f_out.write("bad\t1.5\n")
+    res = run_design(["custom", "-i", idx, "--gtf", gtf, "-d", d, "-o", "grid", "--grid", grid])
+
+    assert res.returncode == 1
+    assert "design grid_bad: --nbp_known and --nbp_novel must be in the interval [0,1]" in res.stderr
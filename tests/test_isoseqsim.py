@@ -0,0 +1,135 @@
+"""Tests of the IsoSeqSim read simulation (src/IsoSeqSim/utilities)"""
+
+import importlib.util
+import os
+
+import numpy as np
+
+# PacBio Sequel error rates used by simulate_reads.pb_simulation
+ER_SUB = 0.01731
+ER_INS = 0.02204
+ER_DEL = 0.01090
+
+
+def load_isoseqsim():
+    """Import py_isoseqsim_simulate_reads_normal.py, which is run as a script"""
+
+    path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                        "src", "IsoSeqSim", "utilities", "py_isoseqsim_simulate_reads_normal.py")
+    spec = importlib.util.spec_from_file_location("py_isoseqsim_simulate_reads_normal", path)
+    isoseqsim = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(isoseqsim)
+    return isoseqsim
+
+
+def baseline_mutate_read(read_seq, error_type, error_prob):
+    """Per-nucleotide error injection of IsoSeqSim before vectorization"""
+
+    read_seq = read_seq.upper()
+
+    dic_error_no = {"A":"A","C":"C","G":"G","T":"T"}
+    dic_error_sub = {"A":np.random.choice(["C","G","T"]),"C":np.random.choice(["A","G","T"]),"G":np.random.choice(["A","C","T"]),"T":np.random.choice(["A","C","G"])}
+    dic_error_ins = {"A":"A"+np.random.choice(["A","C","G","T"]),"C":"C"+np.random.choice(["A","C","G","T"]),"G":"G"+np.random.choice(["A","C","G","T"]),"T":"T"+np.random.choice(["A","C","G","T"])}
+    dic_error_del = {"A":"","C":"","G":"","T":""}
+
+    dic_error = {"no":dic_error_no,"sub":dic_error_sub,"ins":dic_error_ins,"del":dic_error_del}
+    read_seq_new = ""
+    for nuc in read_seq:
+        nuc_new = dic_error[np.random.choice(error_type,p=error_prob)][nuc]
+        read_seq_new += nuc_new
+    return read_seq_new
+
+
+def random_seq(length: int, seed: int) -> str:
+    return "".join(np.random.default_rng(seed).choice(list("ACGT"), size=length))
+
+
+def read_stats(isoseqsim, read_seq: str, rates: tuple, n_reads: int, seed: int) -> tuple:
+    """Length mean/sd and mismatch rate of the reads of both implementations"""
+
+    error_type, error_prob = isoseqsim.extract_error_rate(*rates)
+
+    np.random.seed(seed)
+    old_reads = [baseline_mutate_read(read_seq, error_type, error_prob) for i in range(n_reads)]
+    rng = np.random.default_rng(seed)
+    new_reads = [isoseqsim.mutate_read(read_seq, error_type, error_prob, rng) for i in range(n_reads)]
+
+    # The mismatch rate is only defined when there are no insertions or deletions
+    ref = np.frombuffer(read_seq.encode(), dtype=np.uint8)
+    stats = []
+    for reads in [old_reads, new_reads]:
+        lengths = np.array([len(read) for read in reads])
+        if (lengths == len(ref)).all():
+            mismatch = np.mean([np.frombuffer(read.encode(), dtype=np.uint8) != ref for read in reads])
+        else:
+            mismatch = None
+        stats.append((lengths.mean(), lengths.std(), mismatch))
+    return stats
+
+
+def test_mutate_read_keeps_error_rates():
+    isoseqsim = load_isoseqsim()
+    read_seq = random_seq(1000, 1)
+    n_reads = 100
+
+    # Only substitutions: same length and the mismatch rate is the substitution rate
+    old, new = read_stats(isoseqsim, read_seq, (ER_SUB, 0, 0), n_reads, 3)
+    assert old[0] == new[0] == len(read_seq)
+    assert abs(old[2] - ER_SUB) < 0.003 and abs(new[2] - ER_SUB) < 0.003
+
+    # Only insertions or deletions: the length changes by the insertion/deletion rate
+    old, new = read_stats(isoseqsim, read_seq, (0, ER_INS, 0), n_reads, 4)
+    assert abs(old[0] / len(read_seq) - 1 - ER_INS) < 0.003
+    assert abs(new[0] / len(read_seq) - 1 - ER_INS) < 0.003
+    old, new = read_stats(isoseqsim, read_seq, (0, 0, ER_DEL), n_reads, 5)
+    assert abs(1 - old[0] / len(read_seq) - ER_DEL) < 0.003
+    assert abs(1 - new[0] / len(read_seq) - ER_DEL) < 0.003
+
+
+def test_mutate_read_keeps_length_distribution():
+    isoseqsim = load_isoseqsim()
+    read_seq = random_seq(1000, 2)
+
+    old, new = read_stats(isoseqsim, read_seq, (ER_SUB, ER_INS, ER_DEL), 200, 6)
+
+    # Mean within 3 standard errors and similar spread
+    mean_se = old[1] / np.sqrt(200)
+    assert abs(old[0] - new[0]) < 3 * np.sqrt(2) * mean_se
+    assert abs(new[0] - len(read_seq) * (1 + ER_INS - ER_DEL)) < 3 * mean_se
+    assert 0.8 < new[1] / old[1] < 1.25
+
+
+def test_mutate_read_is_reproducible():
+    isoseqsim = load_isoseqsim()
+    read_seq = random_seq(500, 3)
+    error_type, error_prob = isoseqsim.extract_error_rate(ER_SUB, ER_INS, ER_DEL)
+
+    read1 = isoseqsim.mutate_read(read_seq, error_type, error_prob, np.random.default_rng(7))
+    read2 = isoseqsim.mutate_read(read_seq, error_type, error_prob, np.random.default_rng(7))
+    assert read1 == read2
+    assert set(read1) <= set("ACGT")
+    assert isoseqsim.mutate_read("", error_type, error_prob, np.random.default_rng(7)) == ""
+
+
+def test_end_uniforms_do_not_depend_on_the_split():
+    isoseqsim = load_isoseqsim()
+    read_key, end_key = isoseqsim.iso_keys(7, "G1.T1")
+
+    u = isoseqsim.end_uniforms(end_key, 0, 20)
+    assert u.shape == (20, 2)
+    for first_read, read_count in [(1, 4), (2, 7), (5, 15)]:
+        assert np.array_equal(isoseqsim.end_uniforms(end_key, first_read, read_count),
+                              u[first_read:first_read + read_count])
+
+
+def test_simulated_reads_do_not_depend_on_the_split():
+    isoseqsim = load_isoseqsim()
+    error_type, error_prob = isoseqsim.extract_error_rate(ER_SUB, ER_INS, ER_DEL)
+    table = isoseqsim.compile_completeness([10, 50, 0], [0.3, 0.2, 0.5])
+    isoseqsim.init_worker({}, error_type, error_prob, table, table, 7)
+    read_seq = random_seq(300, 4)
+
+    reads = isoseqsim.simulate_iso_reads("G1.T1", read_seq, 0, 12)
+    split = isoseqsim.simulate_iso_reads("G1.T1", read_seq, 0, 5) + isoseqsim.simulate_iso_reads("G1.T1", read_seq, 5, 7)
+    assert reads == split
+    assert len(set(len(read) for read, iso, qual in reads)) > 1
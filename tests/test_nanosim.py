@@ -0,0 +1,129 @@
+"""Tests of the NanoSim read simulation (src/NanoSim/src/simulator.py)"""
+
+import os
+import random
+import sys
+
+import numpy as np
+import pytest
+
+pytest.importorskip("HTSeq")
+from scipy.stats import ks_2samp
+from sklearn.neighbors import KernelDensity
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src", "NanoSim", "src"))
+import simulator
+
+# Reference lengths in the dense part and in the tail of the length model
+TRX_LENGTHS = [800, 2500, 5000]
+N_READS = 200
+# Aligned reads of the baseline run. At sparse lengths its aligned-length distribution depends on this number, the
+# KDE pools follow the one of large runs
+BASELINE_READS = 20000
+
+
+def length_kde() -> KernelDensity:
+    """2D KDE of (reference length, aligned length) like the one of the NanoSim models"""
+
+    rng = np.random.RandomState(1)
+    ref_len = rng.gamma(3, 500, (2000, 1)) + 200
+    aligned_len = ref_len * rng.uniform(0.5, 1.0, (2000, 1))
+    return KernelDensity(bandwidth=20).fit(np.hstack([ref_len, aligned_len]))
+
+
+def baseline_aligned_lengths(kde: KernelDensity, num_simulate: int, seed: int) -> dict:
+    """Aligned lengths as chosen by NanoSim before the KDE pools
+
+    The reads are simulated in a random order and take the sample nearest to
+    their transcript length in a KDE sample of num_simulate lengths, which is
+    drawn again when a transcript is found twice
+    """
+
+    np.random.seed(seed)
+    reads = [L for L in TRX_LENGTHS for i in range(N_READS)]
+    random.Random(seed).shuffle(reads)
+
+    aligned = {L: [] for L in TRX_LENGTHS}
+    sampled_2d_lengths = kde.sample(num_simulate)
+    trx_sampled = set()
+    for L in reads:
+        if L in trx_sampled:
+            sampled_2d_lengths = kde.sample(num_simulate)
+            trx_sampled = set()
+        idx = np.abs(sampled_2d_lengths[:, 0] - L).argmin()
+        aligned[L].append(int(sampled_2d_lengths[idx][1]))
+        trx_sampled.add(L)
+    return aligned
+
+
+def pool_aligned_lengths(kde: KernelDensity, seed: int, n_reads: int = N_READS) -> dict:
+    simulator.kde_aligned_2d = kde
+    simulator.kde_pools.clear()
+
+    aligned = {L: [] for L in TRX_LENGTHS}
+    for L in TRX_LENGTHS:
+        for trx_read in range(n_reads):
+            aligned[L].append(simulator.select_nearest_kde2d(seed, "T%d" %(L), trx_read, L))
+    return aligned
+
+
+def test_kde_pools_keep_aligned_length_distribution():
+    kde = length_kde()
+
+    old = baseline_aligned_lengths(kde, BASELINE_READS, 7)
+    new = pool_aligned_lengths(kde, 7)
+
+    for L in TRX_LENGTHS:
+        old_len, new_len = np.array(old[L]), np.array(new[L])
+        assert ks_2samp(old_len, new_len).pvalue > 0.01
+        assert abs(old_len.mean() - new_len.mean()) < 3 * np.sqrt(2 / N_READS) * old_len.std()
+
+
+def test_kde_pools_do_not_depend_on_the_process():
+    kde = length_kde()
+    aligned = pool_aligned_lengths(kde, 7)
+
+    # Another process simulating the reads of a transcript in a different order gets the same lengths
+    simulator.kde_pools.clear()
+    for trx_read in reversed(range(N_READS)):
+        assert simulator.select_nearest_kde2d(7, "T2500", trx_read, 2500) == aligned[2500][trx_read]
+
+    # Samples not shorter than max_len are skipped
+    assert all(simulator.select_nearest_kde2d(7, "T5000", trx_read, 5000, 2500) < 2500 for trx_read in range(20))
+
+
+def test_kde_pool_samples_grow_linearly_with_the_reads(monkeypatch):
+    kde = length_kde()
+    simulator.kde_aligned_2d = kde
+    sampled = []
+
+    def count_samples(kde, num, log=False, flatten=True):
+        sampled.append(num)
+        return kde.sample(num)
+    monkeypatch.setattr(simulator, "get_length_kde", count_samples)
+
+    # A single highly expressed transcript, in the dense part and in the tail of the model
+    for L in [2500, 5000]:
+        samples = []
+        for n_reads in [500, 2000]:
+            simulator.kde_pools.clear()
+            del sampled[:]
+            for trx_read in range(n_reads):
+                simulator.select_nearest_kde2d(7, "T%d" %(L), trx_read, L)
+            samples.append(sum(sampled))
+        assert samples[0] <= 500 / simulator.KDE_POOL_READS * simulator.KDE_POOL_MAX
+        assert 3.5 < samples[1] / samples[0] < 4.5
+
+
+def test_shuffled_reads_by_blocks():
+    np.random.seed(1)
+    units = [("T1", 0, 25, 0), ("T2", 10, 12, 40), ("T3", 0, 3, 60)]
+    reads = list(simulator.shuffled_reads(units))
+
+    expected = [(ref_trx, j0 + j, index0 + j) for ref_trx, j0, count, index0 in units for j in range(count)]
+    assert sorted(reads) == sorted(expected)
+    assert reads != expected
+
+    # The reads of a pool block are simulated one after the other
+    blocks = [(ref_trx, trx_read // simulator.KDE_POOL_READS) for ref_trx, trx_read, index in reads]
+    assert len(set(blocks)) == len([b for i, b in enumerate(blocks) if i == 0 or b != blocks[i - 1]])